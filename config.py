@@ -19,8 +19,13 @@ class monkeyConfig(object):
         self.image_extension = '.npy'
         self.label_extension = '.npy' 
         self.occlusion_extension = '.npy'
+        self.frame_index = 'frame_index.npz'  # Kept in tfrecord_dir. Cached depth/label/pixel/occlusion file index, rebuilt when a directory changes.
+        self.drop_incomplete_frames = True  # Drop frames missing a label/pixel label/occlusion file. If False, raise instead.
         self.model_output = pjoin(self.results_dir, 'model_output') 
         self.tfrecord_dir = pjoin(self.image_dir, 'tfrecords_drew')
+        self.memmap_dir = pjoin(self.image_dir, 'memmaps')  # Output of the memmap dataset backend
+        self.normalized_tfrecord_dir = pjoin(self.image_dir, 'tfrecords_normalized')  # Output of --export_normalized: float32 depth and labels already normalized for the model
+        self.use_normalized_tfrecords = False  # Train/validate from normalized_tfrecord_dir. Its normalization must match image/label settings below.
         self.train_summaries = pjoin(self.results_dir, 'summaries')
         self.train_checkpoint = pjoin(self.results_dir, 'checkpoints')
         self.vgg16_weight_path = pjoin(
@@ -30,12 +35,37 @@ class monkeyConfig(object):
         self.resume_from_checkpoint = None  # '/media/data_cifs/monkey_tracking/batches/CnnMultiLowHigh2/walk-all-png/model_output/cnn_multiscale_low_high_res_2017_05_22_14_59_44/model_31600.ckpt-31600'
 
         # Tfrecords
+        self.dataset_backend = 'tfrecords'  # 'tfrecords' or 'memmap' (fixed-shape .npy memmaps in memmap_dir, for datasets on local disk)
         self.new_tf_names = {'train': 'train.tfrecords' , 'val': 'val.tfrecords'}  # {'train': 'train_2mill.tfrecords', 'val': 'val_2mill.tfrecords'}
-        self.train_tfrecords = 'train.tfrecords'  # Decouple the these vars so you can create new records while training #'train_2mill.tfrecords' 
-        self.val_tfrecords = 'val.tfrecords'  # 'val_2mill.tfrecords'        
+        self.train_tfrecords = 'train.tfrecords'  # Decouple the these vars so you can create new records while training. The joints readers also read its shards (train-*-of-*.tfrecords). #'train_2mill.tfrecords' 
+        self.val_tfrecords = 'val.tfrecords'  # 'val_2mill.tfrecords'
+        self.num_readers = 4  # Shards read in parallel by data_loader_joints.inputs
+        self.input_pipeline = 'queues'  # 'queues' (data_loader_joints.inputs) or 'dataset' (tf.data, data_loader_joints.dataset_inputs)
+        self.num_parallel_calls = 8  # Parallel example decodes in the tf.data pipeline
+        self.prefetch_batches = 2  # Batches the tf.data pipeline prepares ahead of the model step
+        self.batch_decode = True  # Parse and normalize whole batches (tf.parse_example) instead of one example at a time
+        self.input_summary_steps = 100  # Steps between input wait time / queue fill level summaries
+        self.profile_window = 500  # Steps in the rolling step time percentiles (p50/p95/p99) and input wait/compute/transfer breakdown
+        self.profile_trace_steps = 1000  # Steps between full RunMetadata traces (timeline_<step>.json in summary_dir, for chrome://tracing). None disables them.
+        self.input_autotune = False  # Start extra enqueue threads while steps wait on input (queue pipelines). The chosen counts are printed so they can be pinned.
+        self.autotune_max_threads = 32  # Max extra enqueue threads started by the autotuner
+        self.autotune_interval = 50  # Steps between autotune decisions
+        self.autotune_wait_threshold = 0.1  # Fraction of step time spent waiting on input that triggers another thread
         self.max_train = None  # Limit the number of files we're going to store in a tfrecords. Set to None if there's no limit.
+        self.tfrecord_shards = 32  # Number of shards written per split, e.g. train-00000-of-00032.tfrecords
+        self.ingestion_workers = None  # Processes used by process_data. Set to None to use every core.
+        self.ingestion_io_threads = 4  # Threads per ingestion worker reading frames ahead of encoding
+        self.ingestion_read_ahead = 16  # Max frames read ahead per ingestion worker
+        self.ingestion_manifest = 'manifest.json'  # Kept in tfrecord_dir. Lists encoded depth files so process_data only appends new frames.
+        self.rebuild_tfrecords = False  # Delete the tracked shards and re-encode everything
         self.max_depth = 1300.  # Divide each image by this value to normalize it to [0, 1]. This is the only normalization we will do. Must be a float!
         self.background_constant = self.max_depth * 2  # HIGH_NUMBER
+        self.depth_encoding = 'float32'  # 'float32' (3 channels, legacy), 'uint16' or 'float16' (1 channel relative to max_depth, depths above max_depth are clipped)
+        self.crop_to_monkey = False  # Store only the padded bounding box of the non-zero depth (plus its offset) in the tfrecords. The loader re-embeds it.
+        self.crop_padding = 16  # Pixels (at image_target_size) kept around the monkey's bounding box
+        self.tfrecord_compression = None  # None, 'ZLIB' or 'GZIP', for every tfrecord writer and reader (the joints readers take it from the dataset header). Depth maps are mostly constant background and compress well; trades reader CPU for share bandwidth.
+        self.dataset_header = 'dataset_header.json'  # Kept in tfrecord_dir. Records the format version and depth encoding of the tfrecords.
+        self.dataset_stats = 'dataset_stats'  # Kept in tfrecord_dir as dataset_stats_{train,val}.npz. Streaming depth/joint/occlusion statistics written during ingestion.
 
         # Feature extraction settings
         self.offset_nn = 30  # random +/- x,y pixel offset range # Tune this
@@ -64,8 +94,11 @@ class monkeyConfig(object):
             # 'random_crop'
             # 'left_right' 
         ]
-        # ['left_right, up_down, random_crop,
-        # random_brightness, random_contrast, rotate']
+        # Applied to training batches with matching label/occlusion transforms (needs batch_decode):
+        # ['left_right', 'up_down', 'rotate', 'random_crop', 'depth_jitter']
+        self.max_rotation = 15.  # Degrees, for 'rotate'
+        self.max_shift = 16  # Pixels, for 'random_crop' (a shifted crop padded back to image_target_size)
+        self.depth_jitter = 20.  # Max foreground depth offset, for 'depth_jitter'
         self.train_batch = 16
         self.validation_batch = 16
         self.ratio = None  # [0.1, 0.9]
@@ -73,16 +106,34 @@ class monkeyConfig(object):
         self.hold_lr = 5e-4
         self.wd_penalty = None
         self.keep_checkpoints = 100
+        self.keep_best_checkpoints = 5  # tf_model_cnn_joints keeps this many best checkpoints (by validation error), plus the latest one
+        self.checkpoint_index = 'checkpoint_index.json'  # Kept in train_checkpoint. Metrics of every checkpoint by step, and the best/latest paths.
+        self.async_writes = True  # Write validation outputs and checkpoints (from a host snapshot of the variables) on a background thread
+        self.max_pending_writes = 32  # Queued writes before the training loop waits for the writer
         self.optimizer = 'adam'
         self.steps_before_validation = 1000
+        self.log_steps = 10  # Steps between training status prints. The training correlation is only fetched on these steps.
+        self.lean_fetches = True  # Fetch only train_op and the loss on ordinary steps; images and predictions are copied to the host on validation steps only
+        self.full_validation = True  # Score the whole val split (decoded once, in a fixed order) at every validation step instead of one random val batch
+        self.full_validation_batch = 64  # Batch size of the full validation pass
+        self.validation_cache = None  # Local directory for the decoded val split (reused while the records are unchanged). None keeps it in memory only.
+        self.hard_example_sampling = False  # Draw training frames in proportion to their recent loss, with importance weights (memmap backend only)
+        self.hard_example_alpha = 1.  # Sampling priority is loss ** alpha. 0 is uniform.
+        self.hard_example_uniform_mix = 0.5  # Share of uniform sampling. Bounds the importance weights by 1 / uniform_mix.
+        self.hard_example_decay = 0.9  # Moving average decay of each frame's loss
+        self.hard_example_occlusion_boost = 1.  # Priority multiplier 1 + boost * fraction of occluded joints
         # for a weighted cost. First entry = background.
 
         # Training settings
         self.num_classes = 23 * 3  # there are 23 * 3 (x/y/z) joint coors
-        self.use_training_loss = False  # early stopping based on loss
-        self.early_stopping_rounds = 100
+        self.use_training_loss = False  # early stopping based on loss. The CNN trainer then schedules on the mean training loss since the last validation instead of the validation error.
+        self.early_stopping_rounds = 100  # The CNN trainer stops after this many validation rounds without improvement
+        self.lr_plateau_rounds = 5  # Validation rounds without improvement before the learning rate is decayed. A plateau at min_lr stops training.
+        self.lr_decay_factor = 0.1
+        self.min_lr = 1e-6
+        self.plateau_threshold = 1e-3  # Relative improvement needed to count as better
         self.test_proprtion = 0.1  # TEST_RATIO
-        self.mean_file = 'mean_file'  # Double check: used in training?
+        self.mean_file = 'mean_file'  # Only used by ops/data_processing.py. The joint tfrecords write dataset_stats instead.
         self.normalize_labels = True
 
         # Labels for the rendered images
@@ -0,0 +1,108 @@
+import os
+import json
+import numpy as np
+import tensorflow as tf
+from glob import glob
+
+
+class CheckpointManager(object):
+    """Keeps the keep_best checkpoints with the lowest validation score plus
+    the latest one (for resuming) and deletes the rest. Every checkpoint's
+    metrics stay in a JSON index in checkpoint_dir, keyed by step:
+
+        {"best": path, "latest": path,
+         "checkpoints": {"1000": {"path": path or null, "score": ...,
+                                  "metrics": {...}}, ...}}
+
+    A checkpoint whose path is null was deleted. A score of None (no
+    validation) never counts as best."""
+
+    def __init__(
+            self,
+            checkpoint_dir,
+            keep_best=5,
+            index_name='checkpoint_index.json'):
+        self.keep_best = keep_best
+        self.index_path = os.path.join(checkpoint_dir, index_name)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'best': None, 'latest': None, 'checkpoints': {}}
+
+    def get_ranked(self):
+        """Steps of the kept checkpoints with a score, best first."""
+        scored = [
+            (v['score'], int(k))
+            for k, v in self.index['checkpoints'].items()
+            if v['path'] is not None and v['score'] is not None]
+        return [step for _, step in sorted(scored)]
+
+    def add(self, step, checkpoint_path, score=None, metrics=None):
+        """Registers the checkpoint Saver.save wrote at checkpoint_path and
+        deletes the checkpoints that fell out of the best and latest."""
+        if score is not None:
+            score = float(score)
+        self.index['checkpoints'][str(step)] = {
+            'path': checkpoint_path,
+            'score': score,
+            'metrics': dict(
+                (k, np.asarray(v).tolist())
+                for k, v in (metrics or {}).items())
+        }
+        self.index['latest'] = checkpoint_path
+        ranked = self.get_ranked()
+        keep = set(ranked[:self.keep_best] + [step])
+        for k, v in self.index['checkpoints'].items():
+            if v['path'] is not None and int(k) not in keep:
+                for f in glob(v['path'] + '.*'):
+                    os.remove(f)
+                v['path'] = None
+        if len(ranked):
+            self.index['best'] = self.index['checkpoints'][
+                str(ranked[0])]['path']
+        self.write_index()
+
+    def write_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=4, sort_keys=True)
+        os.rename(tmp_path, self.index_path)
+
+    def best(self):
+        """Path of the checkpoint with the lowest validation score."""
+        return self.index['best']
+
+    def latest(self):
+        return self.index['latest']
+
+
+def get_checkpoint_step(checkpoint_path):
+    """The global step a checkpoint was saved at: its global_step variable
+    or, for checkpoints written without one, the -step suffix of its name."""
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    if reader.has_tensor('global_step'):
+        return int(reader.get_tensor('global_step'))
+    suffix = checkpoint_path.split('-')[-1]
+    if suffix.isdigit():
+        return int(suffix)
+    return 0
+
+
+def restore_checkpoint(sess, checkpoint_path, var_list=None):
+    """Restores the variables of var_list (default: all global variables)
+    that the checkpoint holds with a matching shape. Returns the variables
+    it did not hold, e.g. state added since it was written, which keep
+    their initial values."""
+    if var_list is None:
+        var_list = tf.global_variables()
+    shapes = tf.train.NewCheckpointReader(
+        checkpoint_path).get_variable_to_shape_map()
+    restore_vars, missing = [], []
+    for v in var_list:
+        if shapes.get(v.op.name) == v.get_shape().as_list():
+            restore_vars += [v]
+        else:
+            missing += [v]
+    tf.train.Saver(restore_vars).restore(sess, checkpoint_path)
+    return missing
@@ -2,6 +2,7 @@ import tensorflow as tf
 import numpy as np
 from scipy import misc
 from glob import glob
+from ops.utils import get_tfrecord_options
 
 
 def get_image_size(config):
@@ -45,14 +46,14 @@ def clip_to_value(data, low, high, val, tf_dtype=tf.float32):
 def read_and_decode_single_example(
                     filename, im_size, model_input_shape, num_feats,
                     max_pixels_per_image, train, img_mean_value=None,
-                    feat_mean_value=None, num_channels=2):
+                    feat_mean_value=None, num_channels=2, compression=None):
     """first construct a queue containing a list of filenames.
     this lets a user split up there dataset in multiple files to keep
     size down"""
     filename_queue = tf.train.string_input_producer([filename],
                                                     num_epochs=None)
     # Unlike the TFRecordWriter, the TFRecordReader is symbolic
-    reader = tf.TFRecordReader()
+    reader = tf.TFRecordReader(options=get_tfrecord_options(compression))
     # One can read a single serialized example from a filename
     # serialized_example is a Tensor of type string.
     _, serialized_example = reader.read(filename_queue)
@@ -122,8 +123,9 @@ def read_and_decode_single_example(
 def read_and_decode(
                     filename_queue, im_size, model_input_shape, num_feats,
                     max_pixels_per_image, train, img_mean_value=None,
-                    feat_mean_value=None, num_channels=2, sample=True):
-    reader = tf.TFRecordReader()
+                    feat_mean_value=None, num_channels=2, sample=True,
+                    compression=None):
+    reader = tf.TFRecordReader(options=get_tfrecord_options(compression))
     _, serialized_example = reader.read(filename_queue)
     features = tf.parse_single_example(
         serialized_example,
@@ -217,7 +219,7 @@ def augment_data(image, model_input_shape, im_size, train):
 def inputs(
         tfrecord_file, batch_size, im_size, model_input_shape, num_feats,
         train=None, num_epochs=None, feat_mean_value=None,
-        max_pixels_per_image=200, sample=False):
+        max_pixels_per_image=200, sample=False, compression=None):
 
     with tf.name_scope('input'):
         filename_queue = tf.train.string_input_producer(
@@ -233,7 +235,8 @@ def inputs(
             max_pixels_per_image=max_pixels_per_image,
             train=train,
             feat_mean_value=feat_mean_value,
-            sample=sample)
+            sample=sample,
+            compression=compression)
 
         # Shuffle the examples and collect them into batch_size batches.
         # (Internally uses a RandomShuffleQueue.)
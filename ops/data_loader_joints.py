@@ -1,7 +1,9 @@
+import os
 import tensorflow as tf
 import numpy as np
 from scipy import misc
 from glob import glob
+from ops.utils import get_tfrecord_options
 
 
 def get_image_size(config):
@@ -46,15 +48,15 @@ def clip_to_value(data, low, high, val, tf_dtype=tf.float32):
 
 def read_and_decode_single_example(
                     filename, im_size, target_size, model_input_shape, train,
-                    label_shape=22):
+                    label_shape=22, compression=None):
 
     """first construct a queue containing a list of filenames.
     this lets a user split up there dataset in multiple files to keep
     size down"""
-    filename_queue = tf.train.string_input_producer([filename],
-                                                    num_epochs=None)
+    filename_queue = tf.train.string_input_producer(
+        get_tfrecord_files(filename), num_epochs=None)
     # Unlike the TFRecordWriter, the TFRecordReader is symbolic
-    reader = tf.TFRecordReader()
+    reader = tf.TFRecordReader(options=get_tfrecord_options(compression))
     # One can read a single serialized example from a filename
     # serialized_example is a Tensor of type string.
     _, serialized_example = reader.read(filename_queue)
@@ -116,22 +118,250 @@ def apply_crop_coordinates(labels, crop_coors, num_dims=3):
             labels.get_shape()[0]) / num_dims]), tf.float32)
 
 
-def get_feature_dict(occlusions):
-    if occlusions:
-        return {
-          'label': tf.FixedLenFeature([], tf.string),
-          'image': tf.FixedLenFeature([], tf.string),
-          'occlusion': tf.FixedLenFeature([], tf.string)
-                }
+AUGMENTATIONS = [
+    'left_right', 'up_down', 'rotate', 'random_crop', 'depth_jitter']
+
+
+def get_left_right_permutation(joint_order):
+    """Index of the mirror image of every joint, pairing names like
+    lShldr/rShldr. Joints without a partner map to themselves."""
+    swap = {'l': 'r', 'r': 'l'}
+    permutation = []
+    for joint in joint_order:
+        partner = joint
+        if joint[0] in swap and joint[1:2].isupper():
+            partner = swap[joint[0]] + joint[1:]
+        if partner not in joint_order:
+            partner = joint
+        permutation += [joint_order.index(partner)]
+    return permutation
+
+
+def augment_batch(
+        images,
+        labels,
+        occlusions,
+        train,
+        joint_order,
+        max_rotation=15.,
+        max_shift=16,
+        depth_jitter=20.,
+        num_dims=3):
+    """Random per-example augmentations of a [batch, h, w, 1] depth batch
+    with 0 background, applying the matching transform to the
+    [batch, joints * 3] labels. Geometric augmentations need labels in
+    pixel coordinates of the images (convert_labels_to_pixel_space).
+
+    left_right/up_down mirror the image and coordinates; an odd number of
+    mirrorings also swaps the left/right joints (and their occlusions).
+    rotate turns the image by up to max_rotation degrees around its center,
+    random_crop shifts it by up to max_shift pixels (a crop padded back to
+    full size) and depth_jitter adds up to +/- depth_jitter to the
+    foreground depth and the joint z. Joints moved out of the frame are
+    marked as not visible in occlusions."""
+    geometric = [
+        a for a in ['left_right', 'up_down', 'rotate', 'random_crop']
+        if a in train]
+    if len(geometric) and 'convert_labels_to_pixel_space' not in train:
+        raise RuntimeError(
+            'Augmentations %s need pixel space labels.' % geometric)
+    batch_size = int(images.get_shape()[0])
+    h, w = [int(x) for x in images.get_shape()[1:3]]
+    num_joints = int(labels.get_shape()[-1]) // num_dims
+    joints = tf.reshape(labels, [batch_size, num_joints, num_dims])
+    x, y, z = joints[:, :, 0], joints[:, :, 1], joints[:, :, 2]
+    mirrored = tf.zeros([batch_size], dtype=tf.bool)
+    if 'left_right' in train:
+        flip = tf.less(tf.random_uniform([batch_size]), 0.5)
+        images = tf.where(flip, tf.reverse(images, axis=[2]), images)
+        x = tf.where(flip, (w - 1) - x, x)
+        mirrored = tf.logical_xor(mirrored, flip)
+    if 'up_down' in train:
+        flip = tf.less(tf.random_uniform([batch_size]), 0.5)
+        images = tf.where(flip, tf.reverse(images, axis=[1]), images)
+        y = tf.where(flip, (h - 1) - y, y)
+        mirrored = tf.logical_xor(mirrored, flip)
+    if 'rotate' in train:
+        # Counterclockwise on screen, i.e. (dx, dy) -> R(-angle)(dx, dy)
+        angles = tf.random_uniform(
+            [batch_size], -max_rotation, max_rotation) * np.pi / 180.
+        images = tf.contrib.image.rotate(
+            images, angles, interpolation='NEAREST')
+        cx, cy = (w - 1) / 2., (h - 1) / 2.
+        cos = tf.expand_dims(tf.cos(angles), axis=-1)
+        sin = tf.expand_dims(tf.sin(angles), axis=-1)
+        dx, dy = x - cx, y - cy
+        x = cx + dx * cos + dy * sin
+        y = cy - dx * sin + dy * cos
+    if 'random_crop' in train:
+        shifts = tf.cast(tf.random_uniform(
+            [batch_size, 2], -max_shift, max_shift + 1, dtype=tf.int32),
+            tf.float32)
+        images = tf.contrib.image.translate(
+            images, shifts, interpolation='NEAREST')
+        x += shifts[:, :1]
+        y += shifts[:, 1:]
+    if 'depth_jitter' in train:
+        offset = tf.random_uniform([batch_size], -depth_jitter, depth_jitter)
+        foreground = tf.cast(tf.greater(images, 0), tf.float32)
+        images += foreground * tf.reshape(offset, [batch_size, 1, 1, 1])
+        z += tf.expand_dims(offset, axis=-1)
+
+    joints = tf.stack([x, y, z], axis=-1)
+    permutation = get_left_right_permutation(joint_order)
+    if 'left_right' in train or 'up_down' in train:
+        joints = tf.where(
+            mirrored, tf.gather(joints, permutation, axis=1), joints)
+        if occlusions is not None:
+            occlusions = tf.where(
+                mirrored,
+                tf.gather(occlusions, permutation, axis=1),
+                occlusions)
+    if occlusions is not None and len(geometric):
+        in_frame = tf.logical_and(
+            tf.logical_and(
+                tf.greater_equal(joints[:, :, 0], 0),
+                tf.less_equal(joints[:, :, 0], w - 1)),
+            tf.logical_and(
+                tf.greater_equal(joints[:, :, 1], 0),
+                tf.less_equal(joints[:, :, 1], h - 1)))
+        occlusions *= tf.cast(in_frame, tf.float32)
+    labels = tf.reshape(joints, [batch_size, num_joints * num_dims])
+    return images, labels, occlusions
+
+
+DEPTH_DTYPES = {
+    'float32': tf.float32,
+    'uint16': tf.uint16,
+    'float16': tf.float16
+}
+
+
+def dequantize_depth(image, depth_encoding, max_value):
+    """Casts stored depth back to float32 depth units."""
+    image = tf.cast(image, tf.float32)
+    if depth_encoding == 'uint16':
+        image *= (max_value / np.iinfo(np.uint16).max)
+    elif depth_encoding == 'float16':
+        image *= max_value
+    elif depth_encoding != 'float32':
+        raise RuntimeError(
+            'Cannot understand the depth encoding: %s' % depth_encoding)
+    return image
+
+
+def decode_depth(image, target_size, depth_encoding, max_value, crop=None):
+    """Decodes the image bytes of a record into a [h, w, 1] depth map.
+    Quantized encodings are dequantized back to depth units in-graph.
+    Records cropped at ingestion hold only the window crop ([y0, x0, h, w]),
+    which is re-embedded at its offset into a zero (background) frame."""
+    if crop is None:
+        image_shape = list(target_size[:2])
     else:
-        return {
-          'label': tf.FixedLenFeature([], tf.string),
-          'image': tf.FixedLenFeature([], tf.string),
-                }
+        crop = tf.cast(crop, tf.int32)
+        image_shape = [crop[2], crop[3]]
+    if depth_encoding == 'float32':
+        # Legacy records: three float32 channels, keep the first
+        image = tf.decode_raw(image, tf.float32)
+        image = tf.reshape(image, tf.stack(image_shape + [target_size[2]]))
+        image = tf.expand_dims(image[:, :, 0], axis=-1)
+    else:
+        image = dequantize_depth(
+            tf.decode_raw(image, DEPTH_DTYPES[depth_encoding]),
+            depth_encoding,
+            max_value)
+        image = tf.reshape(image, tf.stack(image_shape + [1]))
+    if crop is not None:
+        image = tf.image.pad_to_bounding_box(
+            image, crop[0], crop[1], target_size[0], target_size[1])
+    image.set_shape(list(target_size[:2]) + [1])
+    return image
 
 
-def read_and_decode(
-        filename_queue,
+def normalize_batch(
+        images,
+        labels,
+        train,
+        image_target_size,
+        image_input_size,
+        max_value,
+        normalize_labels,
+        occlusions=None,
+        augmentation=None,
+        background_multiplier=1.01,
+        num_dims=3):
+    """Applies the deterministic transforms of read_and_decode to a whole
+    batch at once. images is [batch, h, w, 1] depth and labels is
+    [batch, label_shape]. augmentation holds the augment_batch settings
+    (joint_order, max_rotation, max_shift, depth_jitter); if it is given,
+    the augmentations listed in train are applied in pixel space, before
+    normalization. Returns images, labels and occlusions."""
+    num_joints = int(labels.get_shape()[-1]) // num_dims
+    if 'convert_labels_to_pixel_space' in train:
+        modifier = np.asarray(
+            image_target_size[:2]).astype(np.float32) / np.asarray(
+            image_input_size[:2]).astype(np.float32)
+        assert modifier[0] == modifier[1]  # Need to generalize eventually
+        labels *= np.tile(
+            np.append(modifier, 1), num_joints).astype(np.float32)
+    if augmentation is not None:
+        images, labels, occlusions = augment_batch(
+            images=images,
+            labels=labels,
+            occlusions=occlusions,
+            train=train,
+            num_dims=num_dims,
+            **augmentation)
+
+    # Convert background values
+    background_constant = (background_multiplier * max_value)
+    images += tf.cast(tf.equal(images, 0), tf.float32) * background_constant
+
+    # Normalize: must apply max value to image and every 3rd label
+    if normalize_labels:
+        labels /= np.tile(
+            [image_target_size[0], image_target_size[1], max_value],
+            num_joints).astype(np.float32)
+        images /= background_constant
+    return images, labels, occlusions
+
+
+def get_normalization_params(
+        train,
+        image_target_size,
+        image_input_size,
+        max_value,
+        normalize_labels,
+        background_multiplier=1.01):
+    """The parameters of the deterministic transforms of normalize_batch.
+    Stored in the header of prenormalized exports so records normalized
+    with other settings are rejected."""
+    return {
+        'convert_labels_to_pixel_space':
+            'convert_labels_to_pixel_space' in train,
+        'image_target_size': list(image_target_size),
+        'image_input_size': list(image_input_size),
+        'max_value': max_value,
+        'normalize_labels': normalize_labels,
+        'background_multiplier': background_multiplier
+    }
+
+
+def get_feature_dict(occlusions, cropped=False):
+    feature_dict = {
+      'label': tf.FixedLenFeature([], tf.string),
+      'image': tf.FixedLenFeature([], tf.string),
+            }
+    if occlusions:
+        feature_dict['occlusion'] = tf.FixedLenFeature([], tf.string)
+    if cropped:
+        feature_dict['crop'] = tf.FixedLenFeature([4], tf.int64)
+        feature_dict['label_offset'] = tf.FixedLenFeature([], tf.string)
+    return feature_dict
+
+
+def decode_example(
+        serialized_example,
         im_size,
         target_size,
         model_input_shape,
@@ -145,30 +375,54 @@ def read_and_decode(
         occlusions=False,
         background_multiplier=1.01,
         num_dims = 3,
-        clip_z=False):
-
-    reader = tf.TFRecordReader()
-    _, serialized_example = reader.read(filename_queue)
-    feature_dict = get_feature_dict(occlusions)
+        clip_z=False,
+        depth_encoding='float32',
+        cropped=False,
+        prenormalized=False):
+    """Parses and normalizes one serialized example. Shared by the queue
+    (read_and_decode) and tf.data (dataset_inputs) pipelines. Records of a
+    prenormalized export are only decoded and reshaped."""
+    feature_dict = get_feature_dict(occlusions, cropped)
     features = tf.parse_single_example(
         serialized_example,
         features=feature_dict
         )
+    if prenormalized:
+        label = tf.decode_raw(features['label'], tf.float32)
+        label.set_shape(label_shape)
+        image = tf.reshape(
+            tf.decode_raw(features['image'], tf.float32),
+            list(target_size[:2]) + [1])
+        if occlusions:
+            occlusion = tf.decode_raw(features['occlusion'], tf.float32)
+            occlusion.set_shape(label_shape // num_dims)
+            return label, image, occlusion
+        else:
+            return label, image
 
     if max_value is None:
         raise RuntimeError('You must pass a max value')
     # Convert from a scalar string tensor (whose single string has
     label = tf.decode_raw(features['label'], tf.float32)
-    image = tf.decode_raw(features['image'], tf.float32)
 
-    # Need to reconstruct channels first then transpose channels
-    image = tf.reshape(image, np.asarray(target_size))
+    # Reconstruct the first depth channel from the record's encoding
+    if cropped:
+        image = decode_depth(
+            features['image'], target_size, depth_encoding, max_value,
+            crop=features['crop'])
+    else:
+        image = decode_depth(
+            features['image'], target_size, depth_encoding, max_value)
     # image = tf.cast(image, tf.float32)
 
     # Insert augmentation and preprocessing here
     # image, crop_coors = augment_data(image, model_input_shape, im_size, train)
     crop_coors = None
     label.set_shape(label_shape)
+    if cropped:
+        # Undo the shift of the labels into crop coordinates
+        label_offset = tf.decode_raw(features['label_offset'], tf.float32)
+        label += tf.tile(label_offset, [label_shape // num_dims])
     # import ipdb;ipdb.set_trace()
     if 'convert_labels_to_pixel_space' in train:
         # 1) Resize to config.image_target_size
@@ -198,9 +452,6 @@ def read_and_decode(
         #             adjust,
         #             [int(label.get_shape()[0]) / len(image_target_size)]),
         #         tf.float32)
-    # Take off first slice of the image
-    image = tf.expand_dims(image[:, :, 0], axis=-1)
-
     # Convert background values
     background_mask = tf.cast(tf.equal(image, 0), tf.float32)
     background_constant = (background_multiplier * max_value)
@@ -252,6 +503,99 @@ def read_and_decode(
         return label, image  # , label_scatter
 
 
+def read_and_decode(filename_queue, compression=None, **kwargs):
+    reader = tf.TFRecordReader(options=get_tfrecord_options(compression))
+    _, serialized_example = reader.read(filename_queue)
+    return decode_example(serialized_example, **kwargs)
+
+
+def decode_batch(
+        serialized_examples,
+        batch_size,
+        target_size,
+        train,
+        image_target_size,
+        image_input_size,
+        max_value,
+        normalize_labels,
+        label_shape=22,
+        occlusions=False,
+        num_dims=3,
+        depth_encoding='float32',
+        cropped=False,
+        augmentation=None,
+        prenormalized=False):
+    """Batch-first counterpart of decode_example: parses batch_size
+    serialized examples with one parse_example and decodes, masks and
+    normalizes them as whole-batch ops. Returns (images, labels) or, with
+    occlusions, (images, labels, occlusions). Cropped records have
+    per-example window sizes, so their depth is still re-embedded one
+    example at a time."""
+    if max_value is None:
+        raise RuntimeError('You must pass a max value')
+    features = tf.parse_example(
+        serialized_examples,
+        features=get_feature_dict(occlusions, cropped))
+    labels = tf.reshape(
+        tf.decode_raw(features['label'], tf.float32),
+        [batch_size, label_shape])
+    occlusion = None
+    if occlusions:
+        occlusion = tf.reshape(
+            tf.decode_raw(features['occlusion'], tf.float32),
+            [batch_size, label_shape // num_dims])
+    if prenormalized:
+        if augmentation is not None:
+            raise RuntimeError(
+                'Prenormalized records cannot be augmented.')
+        images = tf.reshape(
+            tf.decode_raw(features['image'], tf.float32),
+            [batch_size] + list(target_size[:2]) + [1])
+        if occlusions:
+            return images, labels, occlusion
+        else:
+            return images, labels
+    if cropped:
+        images = tf.map_fn(
+            lambda x: decode_depth(
+                x[0], target_size, depth_encoding, max_value, crop=x[1]),
+            (features['image'], features['crop']),
+            dtype=tf.float32)
+        # Undo the shift of the labels into crop coordinates
+        labels += tf.tile(
+            tf.decode_raw(features['label_offset'], tf.float32),
+            [1, label_shape // num_dims])
+    elif depth_encoding == 'float32':
+        # Legacy records: three float32 channels, keep the first
+        images = tf.reshape(
+            tf.decode_raw(features['image'], tf.float32),
+            [batch_size] + list(target_size))[:, :, :, :1]
+    else:
+        images = tf.reshape(
+            dequantize_depth(
+                tf.decode_raw(
+                    features['image'], DEPTH_DTYPES[depth_encoding]),
+                depth_encoding,
+                max_value),
+            [batch_size] + list(target_size[:2]) + [1])
+    images.set_shape([batch_size] + list(target_size[:2]) + [1])
+    images, labels, occlusion = normalize_batch(
+        images=images,
+        labels=labels,
+        train=train,
+        image_target_size=image_target_size,
+        image_input_size=image_input_size,
+        max_value=max_value,
+        normalize_labels=normalize_labels,
+        occlusions=occlusion,
+        augmentation=augmentation,
+        num_dims=num_dims)
+    if occlusions:
+        return images, labels, occlusion
+    else:
+        return images, labels
+
+
 def draw_label_coords(label, canvas_size, dims=3):
     ls = int(label.get_shape()[0])
     num_el = ls // dims
@@ -350,6 +694,24 @@ def augment_data(image, model_input_shape, im_size, train):
     return image, crop_coors
 
 
+def get_tfrecord_files(tfrecord_file):
+    """Expands a tfrecord path, glob or list of either into a sorted list
+    of files. A plain path such as train.tfrecords also matches its
+    shards (train-*-of-*.tfrecords)."""
+    if isinstance(tfrecord_file, basestring):
+        tfrecord_file = [tfrecord_file]
+    patterns = []
+    for pattern in tfrecord_file:
+        patterns += [pattern]
+        if not any(c in pattern for c in '*?['):
+            prefix, ext = os.path.splitext(pattern)
+            patterns += ['%s-*-of-*%s' % (prefix, ext)]
+    files = sorted(set(f for pattern in patterns for f in glob(pattern)))
+    if len(files) == 0:
+        raise RuntimeError('No tfrecords found at: %s' % tfrecord_file)
+    return files
+
+
 def inputs(
         tfrecord_file,
         batch_size,
@@ -364,15 +726,78 @@ def inputs(
         train=None,
         max_value=None,
         num_epochs=None,
-        normalize_labels=True):
+        normalize_labels=True,
+        num_readers=4,
+        depth_encoding='float32',
+        cropped=False,
+        compression=None,
+        batch_decode=False,
+        augmentation=None,
+        prenormalized=False):
+    """Reads tfrecord_file (a path, glob or list of shards) with num_readers
+    parallel readers. Shards are reshuffled every epoch and the readers are
+    interleaved by shuffle_batch_join. With batch_decode, the serialized
+    examples are shuffled and batched first and then decoded by
+    decode_batch; decoded batches are prefetched by a second queue.
+    augmentation (see normalize_batch) requires batch_decode."""
+    if augmentation is not None and not batch_decode:
+        raise RuntimeError('Augmentations require batch_decode.')
     with tf.name_scope('input'):
+        tfrecord_files = get_tfrecord_files(tfrecord_file)
         filename_queue = tf.train.string_input_producer(
-            [tfrecord_file], num_epochs=num_epochs)
+            tfrecord_files, num_epochs=num_epochs, shuffle=True)
+        num_readers = max(1, min(num_readers, len(tfrecord_files)))
+        if batch_decode:
+            serialized_list = []
+            for _ in range(num_readers):
+                reader = tf.TFRecordReader(
+                    options=get_tfrecord_options(compression))
+                _, serialized_example = reader.read(filename_queue)
+                serialized_list += [{'serialized': serialized_example}]
+            serialized_batch = tf.train.shuffle_batch_join(
+                serialized_list,
+                batch_size=batch_size,
+                capacity=1000+3 * batch_size,
+                # Ensures a minimum amount of shuffling of examples.
+                min_after_dequeue=1000)['serialized']
+            batch = decode_batch(
+                serialized_batch,
+                batch_size=batch_size,
+                target_size=target_size,
+                train=train,
+                image_target_size=image_target_size,
+                image_input_size=image_input_size,
+                max_value=max_value,
+                normalize_labels=normalize_labels,
+                label_shape=label_shape,
+                occlusions=return_occlusions is not None,
+                depth_encoding=depth_encoding,
+                cropped=cropped,
+                augmentation=augmentation,
+                prenormalized=prenormalized)
+
+            # Prefetch decoded batches so decoding overlaps with the model
+            if return_occlusions is not None:
+                return tf.train.batch(
+                    list(batch),
+                    batch_size=batch_size,
+                    num_threads=2,
+                    capacity=4 * batch_size,
+                    enqueue_many=True)
+            else:
+                data, labels = tf.train.batch(
+                    list(batch),
+                    batch_size=batch_size,
+                    num_threads=2,
+                    capacity=4 * batch_size,
+                    enqueue_many=True)
+                return data, labels, None
 
         # Even when reading in multiple threads, share the filename
-        # queue.
-        if return_occlusions is not None:
-            label, image, occlusions = read_and_decode(
+        # queue. Each reader pulls whole shards from it.
+        example_list = []
+        for _ in range(num_readers):
+            example_list += [read_and_decode(
                 filename_queue=filename_queue,
                 im_size=im_size,
                 target_size=target_size,
@@ -383,20 +808,75 @@ def inputs(
                 image_input_size=image_input_size,
                 maya_conversion=maya_conversion,
                 max_value=max_value,
-                occlusions=True,
-                normalize_labels=normalize_labels
-                )
-            data, labels, occlusions = tf.train.shuffle_batch(
-                [image, label, occlusions],
+                occlusions=return_occlusions is not None,
+                normalize_labels=normalize_labels,
+                depth_encoding=depth_encoding,
+                cropped=cropped,
+                compression=compression,
+                prenormalized=prenormalized
+                )]
+        if return_occlusions is not None:
+            example_list = [
+                [image, label, occlusions]
+                for label, image, occlusions in example_list]
+            data, labels, occlusions = tf.train.shuffle_batch_join(
+                example_list,
                 batch_size=batch_size,
-                num_threads=2,
                 capacity=1000+3 * batch_size,
                 # Ensures a minimum amount of shuffling of examples.
                 min_after_dequeue=1000)
             return data, labels, occlusions
         else:
-            label, image = read_and_decode(
-                filename_queue=filename_queue,
+            example_list = [
+                [image, label] for label, image in example_list]
+            data, labels = tf.train.shuffle_batch_join(
+                example_list,
+                batch_size=batch_size,
+                capacity=1000+3 * batch_size,
+                # Ensures a minimum amount of shuffling of examples.
+                min_after_dequeue=1000)
+            return data, labels, None
+
+
+def dataset_inputs(
+        tfrecord_file,
+        batch_size,
+        im_size,
+        target_size,
+        model_input_shape,
+        label_shape,
+        image_target_size,
+        image_input_size,
+        maya_conversion,
+        return_occlusions=None,
+        train=None,
+        max_value=None,
+        num_epochs=None,
+        normalize_labels=True,
+        num_readers=4,
+        depth_encoding='float32',
+        cropped=False,
+        compression=None,
+        num_parallel_calls=8,
+        prefetch_batches=2,
+        batch_decode=False,
+        augmentation=None,
+        prenormalized=False):
+    """tf.data version of inputs with the same return value. Shards are
+    reshuffled every epoch and read num_readers at a time, examples are
+    decoded with num_parallel_calls parallel map calls and prefetch_batches
+    finished batches are kept ready while the model step runs. With
+    batch_decode, serialized examples are batched first and each batch is
+    decoded by decode_batch. augmentation requires batch_decode."""
+    if augmentation is not None and not batch_decode:
+        raise RuntimeError('Augmentations require batch_decode.')
+    with tf.name_scope('input'):
+        tfrecord_files = get_tfrecord_files(tfrecord_file)
+        occlusions = return_occlusions is not None
+
+        def parse(serialized_example):
+            example = decode_example(
+                serialized_example,
                 im_size=im_size,
                 target_size=target_size,
                 model_input_shape=model_input_shape,
@@ -405,14 +885,53 @@ def inputs(
                 image_target_size=image_target_size,
                 image_input_size=image_input_size,
                 maya_conversion=maya_conversion,
-                normalize_labels=normalize_labels
-                )
-
-            data, labels = tf.train.shuffle_batch(
-                [image, label],
-                batch_size=batch_size,
-                num_threads=2,
-                capacity=1000+3 * batch_size,
-                # Ensures a minimum amount of shuffling of examples.
-                min_after_dequeue=1000)
+                max_value=max_value,
+                occlusions=occlusions,
+                normalize_labels=normalize_labels,
+                depth_encoding=depth_encoding,
+                cropped=cropped,
+                prenormalized=prenormalized)
+            # Same (image, label[, occlusion]) order as inputs
+            return (example[1], example[0]) + tuple(example[2:])
+
+        dataset = tf.data.Dataset.from_tensor_slices(tfrecord_files)
+        dataset = dataset.shuffle(len(tfrecord_files)).repeat(num_epochs)
+        dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+            lambda f: tf.data.TFRecordDataset(
+                f, compression_type=compression or ''),
+            cycle_length=max(1, min(num_readers, len(tfrecord_files))),
+            sloppy=True))
+        # Matches the capacity of the shuffle queue in inputs
+        dataset = dataset.shuffle(1000 + 3 * batch_size)
+        if batch_decode:
+            dataset = dataset.apply(
+                tf.contrib.data.batch_and_drop_remainder(batch_size))
+            dataset = dataset.map(
+                lambda serialized_batch: decode_batch(
+                    serialized_batch,
+                    batch_size=batch_size,
+                    target_size=target_size,
+                    train=train,
+                    image_target_size=image_target_size,
+                    image_input_size=image_input_size,
+                    max_value=max_value,
+                    normalize_labels=normalize_labels,
+                    label_shape=label_shape,
+                    occlusions=occlusions,
+                    depth_encoding=depth_encoding,
+                    cropped=cropped,
+                    augmentation=augmentation,
+                    prenormalized=prenormalized),
+                num_parallel_calls=num_parallel_calls)
+        else:
+            dataset = dataset.map(
+                parse, num_parallel_calls=num_parallel_calls)
+            dataset = dataset.apply(
+                tf.contrib.data.batch_and_drop_remainder(batch_size))
+        dataset = dataset.prefetch(prefetch_batches)
+        batch = dataset.make_one_shot_iterator().get_next()
+        if occlusions:
+            return batch
+        else:
+            data, labels = batch
             return data, labels, None
@@ -0,0 +1,239 @@
+import os
+import json
+import threading
+import numpy as np
+import tensorflow as tf
+from ops.data_loader_joints import DEPTH_DTYPES, dequantize_depth, \
+    normalize_batch
+
+
+def get_memmap_path(memmap_dir, split, name):
+    return os.path.join(memmap_dir, '%s_%s.npy' % (split, name))
+
+
+def get_memmap_header_path(memmap_dir, split):
+    return os.path.join(memmap_dir, '%s_header.json' % split)
+
+
+class MemmapDataset(object):
+    """Read-only view of a split written by process_data with the memmap
+    backend: fixed-shape depth/label/occlusion .npy memmaps, an index of
+    the rows that hold real frames and a JSON header."""
+
+    def __init__(self, memmap_dir, split):
+        with open(get_memmap_header_path(memmap_dir, split)) as f:
+            self.header = json.load(f)
+        self.depth = np.load(
+            get_memmap_path(memmap_dir, split, 'depth'), mmap_mode='r')
+        self.label = np.load(
+            get_memmap_path(memmap_dir, split, 'label'), mmap_mode='r')
+        if self.header['occlusion_shape'] is not None:
+            self.occlusion = np.load(
+                get_memmap_path(memmap_dir, split, 'occlusion'),
+                mmap_mode='r')
+        else:
+            self.occlusion = None
+        self.index = np.load(get_memmap_path(memmap_dir, split, 'index'))
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_batch(self, idx):
+        """Gathers frames by position in the index. Rows are read in
+        ascending order to keep the page cache access sequential."""
+        rows = np.sort(self.index[idx])
+        if self.occlusion is not None:
+            occlusion = self.occlusion[rows]
+        else:
+            occlusion = np.zeros((len(rows), 0), dtype=np.float32)
+        return self.depth[rows], self.label[rows], occlusion
+
+
+class HardExampleSampler(object):
+    """Samples training frames in proportion to their recent loss.
+
+    Keeps an exponential moving average (decay) of every frame's loss, keyed
+    by its position in the split index. Frames are drawn with probability
+    p_i = uniform_mix / N + (1 - uniform_mix) * q_i, where q_i is
+    proportional to loss_i ** alpha times (1 + occlusion_boost * the
+    fraction of the frame's joints that are occluded). Each draw carries
+    the importance weight 1 / (N * p_i), so the weighted loss has the
+    gradient of uniform sampling in expectation; the uniform share bounds
+    the weights by 1 / uniform_mix. Frames that were never scored keep the
+    largest loss seen so far, so every frame is visited early on."""
+
+    def __init__(
+            self,
+            dataset,
+            alpha=1.,
+            uniform_mix=0.5,
+            decay=0.9,
+            occlusion_boost=1.):
+        if not 0 < uniform_mix <= 1:
+            raise RuntimeError('uniform_mix must be in (0, 1].')
+        self.dataset = dataset
+        self.alpha = alpha
+        self.uniform_mix = uniform_mix
+        self.decay = decay
+        self.losses = np.ones(len(dataset), dtype=np.float64)
+        self.seen = np.zeros(len(dataset), dtype=np.bool)
+        self.prior = np.ones(len(dataset), dtype=np.float64)
+        if dataset.occlusion is not None and occlusion_boost:
+            # Occlusion files store visibility flags
+            for start in range(0, len(dataset), 4096):
+                rows = dataset.index[start:start + 4096]
+                occluded = 1. - np.asarray(
+                    dataset.occlusion[rows], dtype=np.float64).mean(axis=1)
+                self.prior[start:start + 4096] += occlusion_boost * occluded
+        self.lock = threading.Lock()
+        self.probabilities = None
+        self.update_probabilities()
+
+    def update_probabilities(self):
+        losses = self.losses.copy()
+        if self.seen.any():
+            losses[~self.seen] = losses[self.seen].max()
+        priority = (np.maximum(losses, 1e-8) ** self.alpha) * self.prior
+        self.probabilities = (
+            self.uniform_mix / len(priority) +
+            (1 - self.uniform_mix) * priority / priority.sum())
+
+    def sample(self, batch_size):
+        """Returns batch_size positions (sorted, so get_batch keeps their
+        order) and their importance weights."""
+        with self.lock:
+            probabilities = self.probabilities
+        idx = np.sort(np.random.choice(
+            len(probabilities), size=batch_size, p=probabilities))
+        weights = 1. / (len(probabilities) * probabilities[idx])
+        return idx.astype(np.int64), weights.astype(np.float32)
+
+    def update(self, idx, losses):
+        """Records the per-example losses of the frames at positions idx."""
+        with self.lock:
+            first = ~self.seen[idx]
+            self.losses[idx] = np.where(
+                first, losses,
+                self.decay * self.losses[idx] + (1 - self.decay) * losses)
+            self.seen[idx] = True
+            self.update_probabilities()
+
+    def get_stats(self):
+        """Fraction of frames scored so far and the largest weight."""
+        with self.lock:
+            return {
+                'seen': self.seen.mean(),
+                'max_weight': 1. / (
+                    len(self.probabilities) * self.probabilities.min())
+            }
+
+
+def inputs(
+        memmap_dir,
+        split,
+        batch_size,
+        label_shape,
+        image_target_size,
+        image_input_size,
+        return_occlusions=None,
+        train=None,
+        max_value=None,
+        num_epochs=None,
+        normalize_labels=True,
+        num_threads=2,
+        augmentation=None,
+        sampler=None):
+    """Memmap counterpart of data_loader_joints.inputs. Every epoch is a
+    uniform random permutation of the split; batches are gathered straight
+    from the memmaps and normalized (and augmented, see normalize_batch)
+    in-graph, without protobuf parsing.
+
+    With a HardExampleSampler (built on this split), frames are drawn by
+    the sampler instead, num_epochs counting len(split) draws as one epoch,
+    and (images, labels, occlusions, idx, weights) is returned: the
+    positions of the frames in the split and their importance weights."""
+    if max_value is None:
+        raise RuntimeError('You must pass a max value')
+    with tf.name_scope('input'):
+        if sampler is not None:
+            dataset = sampler.dataset
+        else:
+            dataset = MemmapDataset(memmap_dir, split)
+        if dataset.header['max_depth'] != max_value:
+            raise RuntimeError(
+                'The memmaps were written with max_depth %s but config uses '
+                '%s.' % (dataset.header['max_depth'], max_value))
+        if sampler is not None:
+            # Only counts batches, so num_epochs still ends training
+            batch_queue = tf.train.range_input_producer(
+                max(len(dataset) // batch_size, 1),
+                num_epochs=num_epochs,
+                shuffle=False)
+            with tf.control_dependencies([batch_queue.dequeue()]):
+                idx, weights = tf.py_func(
+                    lambda: sampler.sample(batch_size),
+                    [],
+                    [tf.int64, tf.float32],
+                    stateful=True)
+            idx.set_shape([batch_size])
+            weights.set_shape([batch_size])
+        else:
+            index_queue = tf.train.range_input_producer(
+                len(dataset),
+                num_epochs=num_epochs,
+                shuffle=True,
+                capacity=len(dataset))
+            idx = index_queue.dequeue_many(batch_size)
+        depth_encoding = dataset.header['depth_encoding']
+        images, labels, occlusions = tf.py_func(
+            dataset.get_batch,
+            [idx],
+            [DEPTH_DTYPES[depth_encoding], tf.float32, tf.float32],
+            stateful=False)
+        images = dequantize_depth(images, depth_encoding, max_value)
+        images = tf.reshape(
+            images, [batch_size] + list(image_target_size[:2]) + [1])
+        labels.set_shape([batch_size, label_shape])
+        if return_occlusions is not None:
+            occlusions.set_shape([batch_size, label_shape // 3])
+        else:
+            occlusions = None
+        images, labels, occlusions = normalize_batch(
+            images=images,
+            labels=labels,
+            train=train,
+            image_target_size=image_target_size,
+            image_input_size=image_input_size,
+            max_value=max_value,
+            normalize_labels=normalize_labels,
+            occlusions=occlusions,
+            augmentation=augmentation)
+
+        # Prefetch gathered batches so reads overlap with the model step
+        if sampler is not None:
+            if occlusions is None:
+                occlusions = tf.zeros([batch_size, 0])
+            images, labels, occlusions, idx, weights = tf.train.batch(
+                [images, labels, occlusions, idx, weights],
+                batch_size=batch_size,
+                num_threads=num_threads,
+                capacity=4 * batch_size,
+                enqueue_many=True)
+            if return_occlusions is None:
+                occlusions = None
+            return images, labels, occlusions, idx, weights
+        elif return_occlusions is not None:
+            return tf.train.batch(
+                [images, labels, occlusions],
+                batch_size=batch_size,
+                num_threads=num_threads,
+                capacity=4 * batch_size,
+                enqueue_many=True)
+        else:
+            data, labels = tf.train.batch(
+                [images, labels],
+                batch_size=batch_size,
+                num_threads=num_threads,
+                capacity=4 * batch_size,
+                enqueue_many=True)
+            return data, labels, None
@@ -0,0 +1,273 @@
+import os
+import json
+import numpy as np
+import tensorflow as tf
+from ops.data_loader_joints import decode_batch, get_tfrecord_files, \
+    normalize_batch, dequantize_depth, DEPTH_DTYPES
+from ops.data_loader_memmap import MemmapDataset, get_memmap_path
+from ops.utils import get_tfrecord_options
+
+
+def get_padded_chunks(items, chunk_size):
+    """Yields (chunk, num_items) with every chunk holding exactly chunk_size
+    items, so it fits a graph with a static batch size. items can be any
+    iterable. The last chunk is padded by repeating its items."""
+    chunk = []
+    for item in items:
+        chunk += [item]
+        if len(chunk) == chunk_size:
+            yield chunk, chunk_size
+            chunk = []
+    if len(chunk):
+        num_items = len(chunk)
+        yield [chunk[i % num_items] for i in range(chunk_size)], num_items
+
+
+def iterate_decoded_chunks(
+        tfrecord_file,
+        chunk_size,
+        compression=None,
+        **decode_kwargs):
+    """Decodes the examples of tfrecord_file in order with decode_batch,
+    i.e. with exactly the normalization of the training pipeline. Yields
+    the decode_batch outputs of each chunk, trimmed to its real examples."""
+    serialized_examples = (
+        record for f in get_tfrecord_files(tfrecord_file)
+        for record in tf.python_io.tf_record_iterator(
+            f, options=get_tfrecord_options(compression)))
+    with tf.Graph().as_default():
+        serialized = tf.placeholder(tf.string, [chunk_size])
+        batch = decode_batch(
+            serialized, batch_size=chunk_size, **decode_kwargs)
+        with tf.Session() as sess:
+            for chunk, num_items in get_padded_chunks(
+                    serialized_examples, chunk_size):
+                out = sess.run(batch, feed_dict={serialized: chunk})
+                yield [x[:num_items] for x in out]
+
+
+def decode_tfrecord_set(
+        tfrecord_file,
+        chunk_size,
+        compression=None,
+        **decode_kwargs):
+    """Decodes every example of tfrecord_file into memory."""
+    occlusions = decode_kwargs.get('occlusions', False)
+    images, labels, occ = [], [], []
+    for out in iterate_decoded_chunks(
+            tfrecord_file, chunk_size, compression, **decode_kwargs):
+        images += [out[0].astype(np.float16)]
+        labels += [out[1]]
+        if occlusions:
+            occ += [out[2]]
+    return {
+        'images': np.concatenate(images),
+        'labels': np.concatenate(labels),
+        'occlusions': np.concatenate(occ) if occlusions else None
+    }
+
+
+def decode_memmap_set(
+        memmap_dir,
+        chunk_size,
+        train,
+        image_target_size,
+        image_input_size,
+        max_value,
+        normalize_labels):
+    """Normalizes every frame of the memmap val split with normalize_batch."""
+    dataset = MemmapDataset(memmap_dir, 'val')
+    depth_encoding = dataset.header['depth_encoding']
+    images, labels, occ = [], [], []
+    with tf.Graph().as_default():
+        depth_ph = tf.placeholder(
+            DEPTH_DTYPES[depth_encoding],
+            [chunk_size] + list(image_target_size[:2]) + [1])
+        label_ph = tf.placeholder(
+            tf.float32, [chunk_size] + dataset.header['label_shape'])
+        batch = normalize_batch(
+            images=dequantize_depth(depth_ph, depth_encoding, max_value),
+            labels=label_ph,
+            train=train,
+            image_target_size=image_target_size,
+            image_input_size=image_input_size,
+            max_value=max_value,
+            normalize_labels=normalize_labels)[:2]
+        with tf.Session() as sess:
+            for start in range(0, len(dataset), chunk_size):
+                # get_batch reorders rows, so pad after gathering
+                depth, label, occlusion = dataset.get_batch(
+                    np.arange(start, min(start + chunk_size, len(dataset))))
+                num_items = len(label)
+                pad = np.arange(chunk_size) % num_items
+                out = sess.run(
+                    batch,
+                    feed_dict={
+                        depth_ph: depth[pad].reshape(
+                            depth_ph.get_shape().as_list()),
+                        label_ph: label[pad]})
+                images += [out[0][:num_items].astype(np.float16)]
+                labels += [out[1][:num_items]]
+                occ += [occlusion]
+    occlusions = None
+    if dataset.occlusion is not None:
+        occlusions = np.concatenate(occ)
+    return {
+        'images': np.concatenate(images),
+        'labels': np.concatenate(labels),
+        'occlusions': occlusions
+    }
+
+
+def get_source_key(files, params):
+    """Identifies the decoded set: source files, their sizes and mtimes and
+    the decode parameters."""
+    return json.dumps({
+        'files': [[f, os.path.getsize(f), os.path.getmtime(f)]
+                  for f in files],
+        'params': params}, sort_keys=True)
+
+
+def load_validation_set(cache_dir, source_files, params, decode_fn):
+    """Returns the decoded validation set {images, labels, occlusions}.
+    Images are float16 to halve the footprint. With a cache_dir (on local
+    disk), the arrays are stored there as .npy files and reused, memory
+    mapped, for as long as the source files and params are unchanged."""
+    key = get_source_key(source_files, params)
+    key_path = None
+    if cache_dir is not None:
+        key_path = os.path.join(cache_dir, 'validation_key.json')
+        if os.path.exists(key_path):
+            with open(key_path) as f:
+                cached_key = f.read()
+            if cached_key == key:
+                print 'Using cached validation set: %s' % cache_dir
+                val_set = {}
+                for k in ['images', 'labels', 'occlusions']:
+                    path = os.path.join(cache_dir, 'validation_%s.npy' % k)
+                    val_set[k] = np.load(path, mmap_mode='r') if \
+                        os.path.exists(path) else None
+                return val_set
+    val_set = decode_fn()
+    print 'Decoded %s validation frames' % len(val_set['labels'])
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        for k, v in val_set.items():
+            path = os.path.join(cache_dir, 'validation_%s.npy' % k)
+            if v is not None:
+                np.save(path, v)
+            elif os.path.exists(path):
+                os.remove(path)
+        # Written last, so an interrupted save is never reused
+        with open(key_path, 'w') as f:
+            f.write(key)
+    return val_set
+
+
+def get_validation_set(config, dataset_header=None, tfrecord_dir=None):
+    """Decodes (or loads from config.validation_cache) the whole validation
+    split of the configured backend. tfrecord_dir defaults to
+    config.tfrecord_dir."""
+    chunk_size = config.full_validation_batch
+    params = {
+        'train': config.data_augmentations,
+        'image_target_size': config.image_target_size,
+        'image_input_size': config.image_input_size,
+        'max_value': config.max_depth,
+        'normalize_labels': config.normalize_labels,
+        'label_shape': config.num_classes,
+        'occlusions': config.occlusion_dir is not None
+    }
+    if config.dataset_backend == 'memmap':
+        source_files = [
+            get_memmap_path(config.memmap_dir, 'val', k)
+            for k in ['depth', 'label', 'index']]
+
+        def decode_fn():
+            return decode_memmap_set(
+                memmap_dir=config.memmap_dir,
+                chunk_size=chunk_size,
+                train=config.data_augmentations,
+                image_target_size=config.image_target_size,
+                image_input_size=config.image_input_size,
+                max_value=config.max_depth,
+                normalize_labels=config.normalize_labels)
+    else:
+        if tfrecord_dir is None:
+            tfrecord_dir = config.tfrecord_dir
+        validation_data = os.path.join(tfrecord_dir, config.val_tfrecords)
+        source_files = get_tfrecord_files(validation_data)
+        params['dataset_header'] = dataset_header
+
+        def decode_fn():
+            return decode_tfrecord_set(
+                tfrecord_file=validation_data,
+                chunk_size=chunk_size,
+                compression=dataset_header.get('compression'),
+                target_size=config.image_target_size,
+                train=config.data_augmentations,
+                image_target_size=config.image_target_size,
+                image_input_size=config.image_input_size,
+                max_value=config.max_depth,
+                normalize_labels=config.normalize_labels,
+                label_shape=config.num_classes,
+                occlusions=config.occlusion_dir is not None,
+                depth_encoding=dataset_header['depth_encoding'],
+                cropped=dataset_header.get('crop_to_monkey', False),
+                prenormalized=dataset_header.get('prenormalized', False))
+    return load_validation_set(
+        config.validation_cache, source_files, params, decode_fn)
+
+
+def evaluate_validation_set(
+        sess,
+        val_set,
+        images,
+        predictions,
+        occlusion_predictions=None,
+        label_scale=None,
+        num_dims=3):
+    """Runs the model over the whole validation set in fixed order.
+    images is the placeholder the validation model was built on, whose
+    static batch size sets the chunk size. label_scale maps normalized
+    labels back to pixel/depth units. Returns the predictions, the loss
+    (mean over frames of the l2_loss used in training), the per-joint
+    error (Euclidean distance summed over frames and the mean over frames)
+    and, given the occlusion head's logits as occlusion_predictions, the
+    visibility accuracy."""
+    chunk_size = int(images.get_shape()[0])
+    fetches = [predictions]
+    if occlusion_predictions is not None and \
+            val_set['occlusions'] is not None:
+        fetches += [occlusion_predictions]
+    preds, occ_preds = [], []
+    for chunk, num_items in get_padded_chunks(
+            range(len(val_set['labels'])), chunk_size):
+        out = sess.run(
+            fetches,
+            feed_dict={images: val_set['images'][chunk].astype(np.float32)})
+        preds += [out[0][:num_items]]
+        if len(out) > 1:
+            occ_preds += [out[1][:num_items]]
+    preds = np.concatenate(preds)
+    labels = np.asarray(val_set['labels'])
+    num_frames = len(labels)
+    metrics = {
+        'predictions': preds,
+        'loss': 0.5 * np.sum((preds - labels) ** 2) / num_frames
+    }
+    if label_scale is not None:
+        preds = preds * label_scale
+        labels = labels * label_scale
+    joint_error = np.sqrt(np.sum((
+        preds.reshape(num_frames, -1, num_dims) -
+        labels.reshape(num_frames, -1, num_dims)) ** 2, axis=-1))
+    metrics['summed_joint_error'] = joint_error.sum(axis=0)
+    metrics['joint_error'] = metrics['summed_joint_error'] / num_frames
+    metrics['mean_joint_error'] = metrics['joint_error'].mean()
+    if len(occ_preds):
+        metrics['occlusion_accuracy'] = np.mean(
+            (np.concatenate(occ_preds) > 0) ==
+            (np.asarray(val_set['occlusions']) > 0.5))
+    return metrics
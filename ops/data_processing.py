@@ -4,7 +4,7 @@ import itertools
 import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
-from ops.utils import get_files
+from ops.utils import get_files, get_tfrecord_options
 from ops.feature_extraction import get_depth, create_depth_graph, random_offsets, get_label, clip_df
 
 
@@ -55,7 +55,10 @@ def run_depth_feature_extraction(
     """Feature extracts and creates the tfrecords."""
     im_list = []
     feat_list = []
-    with tf.python_io.TFRecordWriter(tf_file) as tfrecord_writer:
+    with tf.python_io.TFRecordWriter(
+            tf_file,
+            options=get_tfrecord_options(
+                config.tfrecord_compression)) as tfrecord_writer:
         for i, (depth, label) in tqdm(
                 enumerate(
                     zip(depth_files, label_files)), total=len(depth_files)):
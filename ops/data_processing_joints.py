@@ -1,9 +1,22 @@
 import os
 import re
+import shutil
+import json
+import fnmatch
+import time
 import numpy as np
+from functools import partial
 import tensorflow as tf
 from tqdm import tqdm
-from ops.utils import get_files
+from multiprocessing import Pool, cpu_count
+from ops.utils import get_shard_name, prefetch_map, read_dataset_header, \
+    write_dataset_header, get_tfrecord_options
+from ops.dataset_stats import DatasetStats, get_stats_path
+from ops.data_loader_memmap import get_memmap_path, get_memmap_header_path
+from ops.data_loader_joints import get_tfrecord_files, \
+    get_normalization_params
+from ops.data_loader_validation import iterate_decoded_chunks
+from glob import glob
 from scipy import misc
 from skimage.transform import resize
 
@@ -26,11 +39,87 @@ def int64_feature(values):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
 
 
+def encode_depth(depth_image, depth_encoding, max_depth):
+    """Stores a depth image in the record encoding. float32 keeps the legacy
+    three channels. uint16/float16 keep only the first channel, scaled
+    to [0, 1] by max_depth and clipped to that range."""
+    if depth_encoding == 'float32':
+        return depth_image.astype(np.float32)
+    depth_image = np.clip(depth_image[:, :, 0] / max_depth, 0, 1)
+    if depth_encoding == 'uint16':
+        max_int = np.iinfo(np.uint16).max
+        return np.round(depth_image * max_int).astype(np.uint16)
+    elif depth_encoding == 'float16':
+        return depth_image.astype(np.float16)
+    else:
+        raise RuntimeError(
+            'Cannot understand the depth encoding: %s' % depth_encoding)
+
+
+MEMMAP_DTYPES = {
+    'float32': np.float32,
+    'uint16': np.uint16,
+    'float16': np.float16
+}
+
+
+def get_dataset_header(config):
+    """Header describing the encoding of the records written by config."""
+    if config.depth_encoding == 'float32':
+        image_shape = config.image_target_size
+    else:
+        image_shape = config.image_target_size[:2] + [1]
+    return {
+        'format_version': 2,
+        'depth_encoding': config.depth_encoding,
+        'image_shape': image_shape,
+        'max_depth': config.max_depth,
+        'crop_to_monkey': config.crop_to_monkey,
+        'compression': config.tfrecord_compression
+    }
+
+
+def get_monkey_crop(depth_image, padding):
+    """Bounding box [y0, x0, y1, x1) of the non-zero depth pixels, grown by
+    padding and clipped to the frame."""
+    foreground = depth_image[:, :, 0] > 0
+    rows = np.where(foreground.any(axis=1))[0]
+    cols = np.where(foreground.any(axis=0))[0]
+    h, w = foreground.shape
+    return (
+        max(rows[0] - padding, 0),
+        max(cols[0] - padding, 0),
+        min(rows[-1] + 1 + padding, h),
+        min(cols[-1] + 1 + padding, w))
+
+
+def crop_frame(depth_image, label_vector, config):
+    """Keeps only the padded bounding box of the monkey. Returns the crop,
+    the labels shifted into crop coordinates, the crop window
+    [y0, x0, h, w] and the label offset that undoes the shift. Only pixel
+    labels are shifted."""
+    y0, x0, y1, x1 = get_monkey_crop(depth_image, config.crop_padding)
+    label_offset = np.zeros(3, dtype=np.float32)
+    if config.use_pixel_xy:
+        # Pixel labels are x/y/z at the render resolution
+        scale = np.asarray(
+            config.image_input_size[:2], dtype=np.float32) / np.asarray(
+            config.image_target_size[:2], dtype=np.float32)
+        label_offset[:2] = [x0 * scale[1], y0 * scale[0]]
+    label_vector = (
+        label_vector.reshape(-1, 3) - label_offset).reshape(
+        label_vector.shape).astype(np.float32)
+    crop = np.asarray([y0, x0, y1 - y0, x1 - x0], dtype=np.int64)
+    return depth_image[y0:y1, x0:x1], label_vector, crop, label_offset
+
+
 def encode_example(
         im,
         label,
         occlusion=None,
-        im_label=None):
+        im_label=None,
+        crop=None,
+        label_offset=None):
     """Encodes a single label/image/feature example into a tfrecord entry."""
     feature = {
         # A Feature contains one of either a int64_list,
@@ -42,6 +131,9 @@ def encode_example(
         feature['im_label'] = bytes_feature(im_label.tostring())
     if occlusion is not None:
         feature['occlusion'] = bytes_feature(occlusion.tostring())
+    if crop is not None:
+        feature['crop'] = int64_feature(crop.tolist())
+        feature['label_offset'] = bytes_feature(label_offset.tostring())
     example = tf.train.Example(
         # Example contains a Features proto object
         features=tf.train.Features(
@@ -76,6 +168,141 @@ def cv_files(
     return depth_files, label_files, occlusion_files, pixel_label_files
 
 
+def read_frame(paths, config, use_npy=True):
+    """I/O half of loading a frame: reads the depth, label, pixel label,
+    occlusion and label image files. paths is (depth, label, pixel_label,
+    occlusion); pixel_label and occlusion may be None."""
+    depth, label, pixel_label, occlusion = paths
+
+    # extract depth image
+    if use_npy:
+        depth_image = np.load(depth)[:, :, :3]
+    else:
+        depth_image = misc.imread(depth, mode='F')[:, :, :3]
+    label_vector = np.load(label)
+    if config.use_pixel_xy:
+        label_vector = np.load(pixel_label)
+    im_label = None
+    if config.use_image_labels:
+        im_label = misc.imread(os.path.join(
+            config.im_label_dir, re.split(
+                config.label_extension,
+                re.split('/', label)[-1])[0] + config.image_extension))[:, :, :3]  # label image
+    if occlusion is not None:
+        occlusion = np.load(occlusion)
+    return depth_image, label_vector, occlusion, im_label
+
+
+def resize_depth_frames(frames, target_size):
+    """Nearest-neighbour resize of channel-last depth frames ([h, w, c], or
+    any number of leading batch dims) to target_size. Integer-factor
+    downsampling is done with strided slicing. It picks the same pixels as
+    skimage's order=0 resize, whose sample for output pixel i is
+    round((i + 0.5) * factor - 0.5) = i * factor + factor // 2. Any other
+    factor falls back to skimage frame by frame."""
+    h, w = frames.shape[-3:-1]
+    th, tw = target_size[:2]
+    if h % th == 0 and w % tw == 0:
+        fy, fx = h // th, w // tw
+        return np.ascontiguousarray(
+            frames[..., fy // 2::fy, fx // 2::fx, :])
+    frame_shape = frames.shape[-3:]
+    flat_frames = frames.reshape((-1,) + frame_shape)
+    resized = np.stack([
+        resize(
+            frame,
+            target_size[:2],
+            preserve_range=True,
+            order=0) for frame in flat_frames])
+    return resized.reshape(frames.shape[:-3] + resized.shape[1:])
+
+
+def clean_frame(frame):
+    """Zeroes the background and nans of a frame returned by read_frame.
+    Returns None for renders that are all 0."""
+    depth_image, label_vector, occlusion, im_label = frame
+    depth_image = depth_image.astype(np.float32)
+    depth_image[depth_image == depth_image.min()] = 0
+
+    # set nans to 0
+    depth_image[np.isnan(depth_image)] = 0.
+    if depth_image.sum() == 0:  # Because of renders that are all 0
+        return None
+    return depth_image, label_vector, occlusion, im_label
+
+
+def prepare_frames(frames, config):
+    """CPU half of loading a chunk of frames: cleans the arrays returned by
+    read_frame and resizes the depth of the whole chunk with one
+    resize_depth_frames call. Returns a list with None for renders that are
+    all 0, else (depth_image, label_vector, occlusion, im_label)."""
+    frames = [clean_frame(frame) for frame in frames]
+    valid = [i for i, frame in enumerate(frames) if frame is not None]
+    if not len(valid):
+        return frames
+
+    # resize to config.image_target_size if needed
+    depth_images = [frames[i][0] for i in valid]
+    if config.image_input_size != config.image_target_size:
+        depth_images = resize_depth_frames(
+            np.stack(depth_images), config.image_target_size)
+    # rescale to [0, 1] based on the config max value.
+    # depth_image /= np.asarray(
+    #     config.max_depth,
+    #     dtype=np.float32)  # cast to make sure this is a float 
+    # depth_image = rescale_zo(depth_image).astype(np.float32)
+
+    for i, depth_image in zip(valid, depth_images):
+        _, label_vector, occlusion, im_label = frames[i]
+        label_vector = label_vector.astype(np.float32)
+        if im_label is not None:
+            im_label[np.isnan(im_label)] = 0
+            if config.image_input_size != config.image_target_size:
+                im_label = misc.imresize(
+                    im_label, config.image_target_size[:2])
+            im_label = im_label.astype(np.float32)
+        if occlusion is not None:
+            occlusion = occlusion.astype(np.float32)
+        frames[i] = (depth_image, label_vector, occlusion, im_label)
+    return frames
+
+
+def iterate_prepared_frames(frames, config):
+    """Yields the prepare_frames results of the frames iterable in order,
+    config.ingestion_read_ahead frames (one read-ahead window) at a time."""
+    chunk = []
+    for frame in frames:
+        chunk += [frame]
+        if len(chunk) == config.ingestion_read_ahead:
+            for prepared in prepare_frames(chunk, config):
+                yield prepared
+            chunk = []
+    for prepared in prepare_frames(chunk, config):
+        yield prepared
+
+
+def read_frames(
+        depth_files,
+        label_files,
+        pixel_label_files,
+        occlusions,
+        config):
+    """Yields read_frame results in order while config.ingestion_io_threads
+    threads read up to config.ingestion_read_ahead frames ahead, so disk
+    reads overlap with resizing and serialization."""
+    num_files = len(depth_files)
+    if pixel_label_files is None:
+        pixel_label_files = [None] * num_files
+    if occlusions is None:
+        occlusions = [None] * num_files
+    use_npy = depth_files[0].split('.')[1] == 'npy'
+    return prefetch_map(
+        partial(read_frame, config=config, use_npy=use_npy),
+        zip(depth_files, label_files, pixel_label_files, occlusions),
+        num_threads=config.ingestion_io_threads,
+        read_ahead=config.ingestion_read_ahead)
+
+
 def create_joint_tf_records(
         depth_files,
         label_files,
@@ -83,85 +310,263 @@ def create_joint_tf_records(
         tf_file,
         config,
         occlusions=None,
-        im_label=None):
+        show_progress=True):
 
-    """Feature extracts and creates the tfrecords."""
-    im_list, num_successful = [], 0
-    if depth_files[0].split('.')[1] == 'npy':
-        use_npy = True
+    """Feature extracts and creates the tfrecords. Returns the streaming
+    DatasetStats of the written frames."""
+    stats, num_successful = DatasetStats(), 0
+    use_npy = depth_files[0].split('.')[1] == 'npy'
+    if show_progress and use_npy:
         print 'Getting depth from npys.'
-    else:
-        use_npy = False
+    elif show_progress:
         print 'Getting depth from images.'
     if config.max_train is not None:
         num_files = config.max_train
     else:
         num_files = len(depth_files)
-        tf_dir = '/'.join(tf_file.split('/')[:-1])
+    tf_dir = '/'.join(tf_file.split('/')[:-1])
     if not os.path.exists(tf_dir):
         os.makedirs(tf_dir)
-    with tf.python_io.TFRecordWriter(tf_file) as tfrecord_writer:
-        for i, (depth, label) in tqdm(
-                enumerate(
-                    zip(depth_files, label_files)),
-                total=num_files):
-
-            # extract depth image
-            if use_npy:
-                depth_image = (np.load(depth)[:, :, :3]).astype(np.float32)
-            else:
-                depth_image = misc.imread(depth, mode='F')[:, :, :3]
-            depth_image[depth_image == depth_image.min()] = 0
-
-            # set nans to 0
-            depth_image[np.isnan(depth_image)] = 0.
-            if depth_image.sum() > 0:  # Because of renders that are all 0
-                # resize to config.image_target_size if needed
-                if config.image_input_size != config.image_target_size:
-                    depth_image = resize(
-                        depth_image,
-                        config.image_target_size[:2],
-                        preserve_range=True,
-                        order=0)
-                # rescale to [0, 1] based on the config max value.
-                # depth_image /= np.asarray(
-                #     config.max_depth,
-                #     dtype=np.float32)  # cast to make sure this is a float 
-                # depth_image = rescale_zo(depth_image).astype(np.float32)
-
+    with tf.python_io.TFRecordWriter(
+            tf_file,
+            options=get_tfrecord_options(
+                config.tfrecord_compression)) as tfrecord_writer:
+        for frame in tqdm(
+                iterate_prepared_frames(
+                    read_frames(
+                        depth_files,
+                        label_files,
+                        pixel_label_files,
+                        occlusions,
+                        config),
+                    config),
+                total=num_files,
+                disable=not show_progress):
+            if frame is not None:
                 # encode -> tfrecord
-                label_vector = np.load(label).astype(np.float32)
-                if config.use_pixel_xy:
-                    pixel_label_vector = np.load(
-                        pixel_label_files[i]).astype(np.float32)
-                    label_vector = pixel_label_vector
-                if config.use_image_labels:
-                    im_label = misc.imread(os.path.join(
-                        config.im_label_dir, re.split(
-                            config.label_extension,
-                            re.split('/', label)[-1])[0] + config.image_extension))[:, :, :3]  # label image
-                    im_label[np.isnan(im_label)] = 0
-                    if config.image_input_size != config.image_target_size:
-                        im_label = misc.imresize(
-                            im_label, config.image_target_size[:2])
-                    im_label = im_label.astype(np.float32)
-
-                im_list.append(np.mean(depth_image))
-                if occlusions is not None:
-                    occlusion = np.load(occlusions[i]).astype(np.float32)
-                else:
-                    occlusion = None
+                depth_image, label_vector, occlusion, im_label = frame
+                stats.update(depth_image, label_vector, occlusion)
+                crop, label_offset = None, None
+                if config.crop_to_monkey:
+                    depth_image, label_vector, crop, label_offset = \
+                        crop_frame(depth_image, label_vector, config)
                 example = encode_example(
-                    im=depth_image.astype(np.float32),
+                    im=encode_depth(
+                        depth_image,
+                        config.depth_encoding,
+                        config.max_depth),
                     label=label_vector,
                     im_label=im_label,
-                    occlusion=occlusion)
+                    occlusion=occlusion,
+                    crop=crop,
+                    label_offset=label_offset)
                 tfrecord_writer.write(example)
                 num_successful += 1
 
             if config.max_train is not None and num_successful > config.max_train:
                 break
-    return im_list
+    return stats
+
+
+def get_manifest_path(config):
+    return os.path.join(config.tfrecord_dir, config.ingestion_manifest)
+
+
+def load_manifest(config):
+    """Loads the ingestion manifest, or starts a new one if there is none or
+    config.rebuild_tfrecords is set. Rebuilding deletes the shards tracked by
+    the old manifest."""
+    manifest_path = get_manifest_path(config)
+    manifest = {'runs': 0, 'shards': {}, 'files': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            old_manifest = json.load(f)
+        if not config.rebuild_tfrecords:
+            return old_manifest
+        print 'Rebuilding: removing %s tracked shards' % len(
+            old_manifest['shards'])
+        for shard in old_manifest['shards'].keys():
+            shard_path = os.path.join(config.tfrecord_dir, shard)
+            for f in [shard_path, get_shard_stats_path(shard_path)]:
+                if os.path.exists(f):
+                    os.remove(f)
+        os.remove(manifest_path)
+    return manifest
+
+
+def save_manifest(manifest, config):
+    """Writes the manifest to a temporary file and renames it over the old
+    one, so a crash can never leave a half-written manifest behind."""
+    manifest_path = get_manifest_path(config)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def get_file_stats(files):
+    """Size and mtime of each file, keyed by file name."""
+    file_stats = {}
+    for f in files:
+        st = os.stat(f)
+        file_stats[os.path.basename(f)] = {
+            'size': st.st_size, 'mtime': st.st_mtime}
+    return file_stats
+
+
+def get_new_frames(depth_files, file_stats, manifest):
+    """Boolean mask of the depth files that the manifest has not encoded
+    yet. Files that changed since they were encoded are reported and
+    skipped; set config.rebuild_tfrecords to re-encode them."""
+    new_mask = np.ones(len(depth_files), dtype=bool)
+    changed = []
+    for i, depth in enumerate(depth_files):
+        name = os.path.basename(depth)
+        if name in manifest['files']:
+            new_mask[i] = False
+            entry = manifest['files'][name]
+            if entry['size'] != file_stats[name]['size'] or \
+                    entry['mtime'] != file_stats[name]['mtime']:
+                changed += [name]
+    if len(changed):
+        print 'Warning: %s encoded frames changed on disk and were skipped ' \
+            '(e.g. %s). Set rebuild_tfrecords to re-encode them.' % (
+                len(changed), changed[0])
+    return new_mask
+
+
+def record_shard(manifest, tf_file, split, depth_files, file_stats):
+    """Marks every depth file of a finished shard as encoded."""
+    shard = os.path.basename(tf_file)
+    manifest['shards'][shard] = {
+        'split': split, 'num_files': len(depth_files)}
+    for depth in depth_files:
+        name = os.path.basename(depth)
+        manifest['files'][name] = dict(
+            file_stats[name], split=split, shard=shard)
+
+
+def get_shard_stats_path(tf_file):
+    return tf_file + '.stats.npz'
+
+
+def get_run_shard_regex(config):
+    """Matches the run-tagged shards process_data writes (e.g.
+    train-r0002-00003-of-00032.tfrecords) and their statistics files."""
+    names = []
+    for tf_name in config.new_tf_names.values():
+        prefix, ext = os.path.splitext(tf_name)
+        names += [r'%s-r\d{4}-\d{5}-of-\d{5}%s' % (
+            re.escape(prefix), re.escape(ext))]
+    return re.compile(r'^(%s)(\.stats\.npz)?$' % '|'.join(names))
+
+
+def clean_tfrecord_dir(manifest, config):
+    """Deletes what a crashed ingestion left behind: half-written shards
+    and shards (with their statistics) that were never committed to the
+    manifest. Their frames are still new, so this run re-encodes them and
+    they are neither read twice nor in both splits. Other
+    tfrecords the manifest does not know about are only reported."""
+    for tmp_file in glob(os.path.join(config.tfrecord_dir, '*.tmp')):
+        print 'Removing incomplete shard: %s' % tmp_file
+        os.remove(tmp_file)
+    shard_regex = get_run_shard_regex(config)
+    untracked = []
+    for f in sorted(os.listdir(config.tfrecord_dir)):
+        match = shard_regex.match(f)
+        if match is not None and match.group(1) not in manifest['shards']:
+            print 'Removing uncommitted shard: %s' % f
+            os.remove(os.path.join(config.tfrecord_dir, f))
+        elif match is None and f.endswith('.tfrecords') and \
+                f not in manifest['shards']:
+            untracked += [f]
+    if len(untracked):
+        print 'Warning: %s tfrecords in %s are not in the manifest and ' \
+            'will still match the training globs.' % (
+                len(untracked), config.tfrecord_dir)
+
+
+def get_split_stats(manifest, split, config):
+    """Statistics of the committed shards of split, merged from their
+    per-shard files. Manifests written before shards had their own
+    statistics fall back to the split sidecar."""
+    stats = DatasetStats()
+    for shard, entry in sorted(manifest['shards'].items()):
+        if entry['split'] != split:
+            continue
+        shard_stats_path = get_shard_stats_path(
+            os.path.join(config.tfrecord_dir, shard))
+        if not os.path.exists(shard_stats_path):
+            stats_path = get_stats_path(
+                config.tfrecord_dir, config.dataset_stats, split)
+            if os.path.exists(stats_path):
+                return DatasetStats.load(stats_path)
+            return DatasetStats()
+        stats.merge(DatasetStats.load(shard_stats_path))
+    return stats
+
+
+def write_shard(shard_args):
+    """Pool worker: writes one tfrecord shard under a .tmp name and returns
+    its final path, the .tmp path and its statistics. The parent commits
+    it with commit_shard."""
+    tf_file = shard_args['tf_file']
+    shard_args = dict(shard_args, tf_file=tf_file + '.tmp')
+    stats = create_joint_tf_records(show_progress=False, **shard_args)
+    return tf_file, tf_file + '.tmp', stats
+
+
+def commit_shard(
+        manifest,
+        tf_file,
+        tmp_file,
+        split,
+        depth_files,
+        file_stats,
+        shard_stats,
+        config):
+    """Saves a finished shard's statistics, renames it into place and then
+    commits both to the manifest. The manifest is the only commit point:
+    until it is saved the shard and its statistics are untracked and
+    clean_tfrecord_dir deletes them on the next run."""
+    shard_stats.save(get_shard_stats_path(tf_file))
+    os.rename(tmp_file, tf_file)
+    record_shard(
+        manifest=manifest,
+        tf_file=tf_file,
+        split=split,
+        depth_files=depth_files,
+        file_stats=file_stats)
+    save_manifest(manifest, config)
+
+
+def get_shard_args(
+        depth_files,
+        label_files,
+        pixel_label_files,
+        occlusion_files,
+        tf_name,
+        config):
+    """Splits a file list into config.tfrecord_shards create_joint_tf_records
+    argument dicts, one per shard."""
+    if config.max_train is not None:
+        depth_files = depth_files[:config.max_train]
+    num_shards = max(1, min(config.tfrecord_shards, len(depth_files)))
+    shard_args = []
+    for shard, idx in enumerate(
+            np.array_split(np.arange(len(depth_files)), num_shards)):
+        shard_args += [{
+            'depth_files': depth_files[idx],
+            'label_files': label_files[idx],
+            'pixel_label_files': pixel_label_files[idx]
+            if pixel_label_files is not None else None,
+            'occlusions': occlusion_files[idx]
+            if occlusion_files is not None else None,
+            'tf_file': os.path.join(
+                config.tfrecord_dir,
+                get_shard_name(tf_name, shard, num_shards)),
+            'config': config
+        }]
+    return shard_args
 
 
 def extract_depth_features_into_tfrecord(
@@ -169,9 +574,16 @@ def extract_depth_features_into_tfrecord(
         label_files,
         pixel_label_files,
         occlusion_files,
+        file_stats,
+        manifest,
         config):
     """Prepares the tf op for nearest neighbor depth features and runs op to
-    make tfrecords from them."""
+    make tfrecords from them. Each split is written as
+    config.tfrecord_shards shards by a pool of worker processes. Every
+    finished shard is committed to the manifest right away, so a crashed
+    run resumes from the last completed shard. The per-split
+    config.dataset_stats sidecars are rewritten from the committed shards'
+    statistics after each commit."""
 
     # Crossvalidate and create tfrecords
     depth_files, label_files, occlusion_files, pixel_label_files = cv_files(
@@ -179,59 +591,427 @@ def extract_depth_features_into_tfrecord(
         label_files,
         occlusion_files,
         pixel_label_files)
-    mean_dict = {}
-    for k in depth_files.keys():
-        print 'Getting depth features: %s' % k
-        im_means = create_joint_tf_records(
-            depth_files=depth_files[k],
-            label_files=label_files[k],
-            pixel_label_files=pixel_label_files[k],
-            tf_file=os.path.join(config.tfrecord_dir, config.new_tf_names[k]),
-            config=config,
-            occlusions=occlusion_files[k])
-        mean_dict[k + '_image'] = im_means
+    if config.ingestion_workers is not None:
+        num_workers = config.ingestion_workers
+    else:
+        num_workers = cpu_count()
+
+    # Tag this run's shards so they never collide with earlier runs
+    manifest['runs'] += 1
+    save_manifest(manifest, config)
+    run_tag = '-r%04d' % manifest['runs']
+    pool = Pool(processes=num_workers)
+    try:
+        for k in depth_files.keys():
+            if not len(depth_files[k]):
+                continue
+            print 'Getting depth features: %s' % k
+            prefix, ext = os.path.splitext(config.new_tf_names[k])
+            shard_args = get_shard_args(
+                depth_files=depth_files[k],
+                label_files=label_files[k],
+                pixel_label_files=pixel_label_files[k],
+                occlusion_files=occlusion_files[k],
+                tf_name=prefix + run_tag + ext,
+                config=config)
+            shard_files = dict(
+                (sa['tf_file'], sa['depth_files']) for sa in shard_args)
+            stats_path = get_stats_path(
+                config.tfrecord_dir, config.dataset_stats, k)
+            split_stats = get_split_stats(manifest, k, config)
+            start_time = time.time()
+            num_frames = split_stats.num_frames
+            for tf_file, tmp_file, shard_stats in tqdm(
+                    pool.imap_unordered(write_shard, shard_args),
+                    total=len(shard_args)):
+                commit_shard(
+                    manifest=manifest,
+                    tf_file=tf_file,
+                    tmp_file=tmp_file,
+                    split=k,
+                    depth_files=shard_files[tf_file],
+                    file_stats=file_stats,
+                    shard_stats=shard_stats,
+                    config=config)
+                split_stats.merge(shard_stats)
+                split_stats.save(stats_path)
+            duration = time.time() - start_time
+            num_frames = split_stats.num_frames - num_frames
+            print 'Encoded %s %s frames in %.1f sec (%.1f frames/sec), ' \
+                '%s in total' % (
+                    num_frames, k, duration, num_frames / duration,
+                    split_stats.num_frames)
+    finally:
+        pool.close()
+        pool.join()
     print 'Finished'
-    return mean_dict
+
+
+def write_memmap_rows(chunk_args):
+    """Pool worker: loads a block of frames and writes them into their rows
+    of the split memmaps. Returns the rows, which of them hold a frame and
+    the block statistics."""
+    rows = chunk_args['rows']
+    config = chunk_args['config']
+    split = chunk_args['split']
+    depth_mm = np.load(
+        get_memmap_path(config.memmap_dir, split, 'depth'), mmap_mode='r+')
+    label_mm = np.load(
+        get_memmap_path(config.memmap_dir, split, 'label'), mmap_mode='r+')
+    if chunk_args['occlusions'] is not None:
+        occlusion_mm = np.load(
+            get_memmap_path(config.memmap_dir, split, 'occlusion'),
+            mmap_mode='r+')
+    stats, valid = DatasetStats(), np.zeros(len(rows), dtype=bool)
+    frames = iterate_prepared_frames(
+        read_frames(
+            chunk_args['depth_files'],
+            chunk_args['label_files'],
+            chunk_args['pixel_label_files'],
+            chunk_args['occlusions'],
+            config),
+        config)
+    for i, (row, frame) in enumerate(zip(rows, frames)):
+        if frame is None:
+            continue
+        depth_image, label_vector, occlusion, _ = frame
+        stats.update(depth_image, label_vector, occlusion)
+        depth_mm[row] = encode_depth(
+            depth_image[:, :, :1],
+            config.depth_encoding,
+            config.max_depth).reshape(depth_mm.shape[1:])
+        label_mm[row] = label_vector.ravel()
+        if occlusion is not None:
+            occlusion_mm[row] = occlusion.ravel()
+        valid[i] = True
+    depth_mm.flush()
+    label_mm.flush()
+    if chunk_args['occlusions'] is not None:
+        occlusion_mm.flush()
+    return rows, valid, stats
+
+
+def create_memmap_dataset(
+        depth_files,
+        label_files,
+        pixel_label_files,
+        occlusion_files,
+        config):
+    """Alternative to the tfrecords for datasets that fit on local disk.
+    Each split becomes fixed-shape depth, label and occlusion .npy memmaps
+    in config.memmap_dir, written in parallel blocks by a worker pool, plus
+    an index of the rows holding real frames and a JSON header. The split
+    is always rewritten from scratch."""
+    depth_files, label_files, occlusion_files, pixel_label_files = cv_files(
+        depth_files,
+        label_files,
+        occlusion_files,
+        pixel_label_files)
+    if config.ingestion_workers is not None:
+        num_workers = config.ingestion_workers
+    else:
+        num_workers = cpu_count()
+    if not os.path.exists(config.memmap_dir):
+        os.makedirs(config.memmap_dir)
+    if config.crop_to_monkey:
+        print 'Memmaps hold fixed-size frames, ignoring crop_to_monkey.'
+    pool = Pool(processes=num_workers)
+    try:
+        for k in depth_files.keys():
+            print 'Writing memmaps: %s' % k
+            num_rows = len(depth_files[k])
+            if config.max_train is not None:
+                num_rows = min(num_rows, config.max_train)
+            header = {
+                'format_version': 1,
+                'num_rows': num_rows,
+                'depth_encoding': config.depth_encoding,
+                'depth_shape': config.image_target_size[:2],
+                'label_shape': [config.num_classes],
+                'occlusion_shape': [config.num_classes // 3]
+                if occlusion_files[k] is not None else None,
+                'max_depth': config.max_depth
+            }
+            np.lib.format.open_memmap(
+                get_memmap_path(config.memmap_dir, k, 'depth'),
+                mode='w+',
+                dtype=MEMMAP_DTYPES[config.depth_encoding],
+                shape=tuple([num_rows] + header['depth_shape']))
+            np.lib.format.open_memmap(
+                get_memmap_path(config.memmap_dir, k, 'label'),
+                mode='w+',
+                dtype=np.float32,
+                shape=tuple([num_rows] + header['label_shape']))
+            if header['occlusion_shape'] is not None:
+                np.lib.format.open_memmap(
+                    get_memmap_path(config.memmap_dir, k, 'occlusion'),
+                    mode='w+',
+                    dtype=np.float32,
+                    shape=tuple([num_rows] + header['occlusion_shape']))
+            chunk_args = []
+            for rows in np.array_split(
+                    np.arange(num_rows),
+                    max(1, min(config.tfrecord_shards, num_rows))):
+                chunk_args += [{
+                    'rows': rows,
+                    'split': k,
+                    'depth_files': depth_files[k][rows],
+                    'label_files': label_files[k][rows],
+                    'pixel_label_files': pixel_label_files[k][rows]
+                    if pixel_label_files[k] is not None else None,
+                    'occlusions': occlusion_files[k][rows]
+                    if occlusion_files[k] is not None else None,
+                    'config': config
+                }]
+            index, split_stats = [], DatasetStats()
+            start_time = time.time()
+            for rows, valid, chunk_stats in tqdm(
+                    pool.imap_unordered(write_memmap_rows, chunk_args),
+                    total=len(chunk_args)):
+                index += [rows[valid]]
+                split_stats.merge(chunk_stats)
+            index = np.sort(np.concatenate(index))
+            np.save(get_memmap_path(config.memmap_dir, k, 'index'), index)
+            header['num_frames'] = len(index)
+            with open(get_memmap_header_path(config.memmap_dir, k), 'w') as f:
+                json.dump(header, f, indent=4)
+            split_stats.save(
+                get_stats_path(config.memmap_dir, config.dataset_stats, k))
+            duration = time.time() - start_time
+            print 'Wrote %s %s frames in %.1f sec (%.1f frames/sec)' % (
+                len(index), k, duration, len(index) / duration)
+    finally:
+        pool.close()
+        pool.join()
+    print 'Finished'
+
+
+def export_normalized_tfrecords(config, chunk_size=64):
+    """Writes a copy of the tfrecords in config.tfrecord_dir whose records
+    hold model-ready float32 depth ([h, w, 1], background filled and
+    normalized) and normalized labels, so training only decodes and
+    reshapes them. The normalization parameters are stored in the header of
+    config.normalized_tfrecord_dir and checked by the trainer. Each source
+    shard becomes one shard of the same name; finished shards are skipped
+    when the export is rerun."""
+    source_header = read_dataset_header(
+        config.tfrecord_dir, config.dataset_header)
+    normalization = get_normalization_params(
+        train=config.data_augmentations,
+        image_target_size=config.image_target_size,
+        image_input_size=config.image_input_size,
+        max_value=config.max_depth,
+        normalize_labels=config.normalize_labels)
+    header = {
+        'format_version': 3,
+        'prenormalized': True,
+        'depth_encoding': 'float32',
+        'image_shape': config.image_target_size[:2] + [1],
+        'max_depth': config.max_depth,
+        'compression': config.tfrecord_compression,
+        'normalization': normalization,
+        'source': source_header
+    }
+    out_dir = config.normalized_tfrecord_dir
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if os.path.exists(os.path.join(out_dir, config.dataset_header)):
+        old_header = read_dataset_header(out_dir, config.dataset_header)
+        if old_header != header:
+            raise RuntimeError(
+                'The export in %s was written as %s but config asks for %s. '
+                'Remove it to re-export.' % (out_dir, old_header, header))
+    write_dataset_header(out_dir, config.dataset_header, header)
+
+    occlusions = config.occlusion_dir is not None
+    for split, pattern in [
+            ('train', config.train_tfrecords),
+            ('val', config.val_tfrecords)]:
+        tf_files = get_tfrecord_files(
+            os.path.join(config.tfrecord_dir, pattern))
+        print 'Exporting %s normalized %s shards to %s' % (
+            len(tf_files), split, out_dir)
+        for tf_file in tqdm(tf_files):
+            out_file = os.path.join(out_dir, os.path.basename(tf_file))
+            if os.path.exists(out_file):
+                continue
+            with tf.python_io.TFRecordWriter(
+                    out_file + '.tmp',
+                    options=get_tfrecord_options(
+                        config.tfrecord_compression)) as tfrecord_writer:
+                for out in iterate_decoded_chunks(
+                        tfrecord_file=tf_file,
+                        chunk_size=chunk_size,
+                        compression=source_header.get('compression'),
+                        target_size=config.image_target_size,
+                        train=config.data_augmentations,
+                        image_target_size=config.image_target_size,
+                        image_input_size=config.image_input_size,
+                        max_value=config.max_depth,
+                        normalize_labels=config.normalize_labels,
+                        label_shape=config.num_classes,
+                        occlusions=occlusions,
+                        depth_encoding=source_header['depth_encoding'],
+                        cropped=source_header.get('crop_to_monkey', False)):
+                    for i in range(len(out[0])):
+                        tfrecord_writer.write(encode_example(
+                            im=out[0][i],
+                            label=out[1][i],
+                            occlusion=out[2][i] if occlusions else None))
+            os.rename(out_file + '.tmp', out_file)
+        stats_path = get_stats_path(
+            config.tfrecord_dir, config.dataset_stats, split)
+        if os.path.exists(stats_path):
+            shutil.copy(stats_path, out_dir)
+
+
+def list_frames(directory, pattern, extension):
+    """Maps frame id -> path for the files of directory that match pattern,
+    using a single os.listdir."""
+    if directory is None or not os.path.isdir(directory):
+        return {}
+    return dict(
+        (f[:-len(extension)], os.path.join(directory, f))
+        for f in fnmatch.filter(os.listdir(directory), pattern))
+
+
+def scan_frames(config):
+    """Lists the depth, label, pixel label and occlusion directories once
+    each and joins them by frame id. Frames without every companion file
+    are reported and dropped (or raise if config.drop_incomplete_frames is
+    False). Occlusions are optional if none exist at all and pixel labels
+    are only needed with config.use_pixel_xy."""
+    depth = list_frames(
+        config.depth_dir, config.depth_regex, config.image_extension)
+    companions = [
+        ('label', list_frames(
+            config.label_dir, '*' + config.label_extension,
+            config.label_extension)),
+        ('occlusion', list_frames(
+            config.occlusion_dir, '*' + config.occlusion_extension,
+            config.occlusion_extension))]
+    if len(companions[-1][1]) == 0:
+        print 'No occlusion files found, ignoring occlusions.'
+        companions = companions[:-1]
+    if config.use_pixel_xy:
+        companions += [('pixel label', list_frames(
+            config.pixel_label_dir, '*' + config.label_extension,
+            config.label_extension))]
+    frame_ids = sorted(depth.keys())
+    complete = np.ones(len(frame_ids), dtype=bool)
+    for name, frames in companions:
+        missing = np.asarray([fid not in frames for fid in frame_ids])
+        if missing.any():
+            print 'Warning: %s frames have no %s file (e.g. %s)' % (
+                missing.sum(), name,
+                frame_ids[int(np.argmax(missing))])
+        complete &= ~missing
+    if not complete.all() and not config.drop_incomplete_frames:
+        raise RuntimeError(
+            '%s frames are incomplete.' % (len(complete) - complete.sum()))
+    frame_ids = [fid for fid, c in zip(frame_ids, complete) if c]
+    print 'Indexed %s complete frames' % len(frame_ids)
+    index = {'depth_files': np.asarray([depth[fid] for fid in frame_ids])}
+    for name, frames in companions:
+        index[name.replace(' ', '_') + '_files'] = np.asarray(
+            [frames[fid] for fid in frame_ids])
+    return index
+
+
+def get_frame_index(config):
+    """Returns the depth, label, pixel label and occlusion (or None) file
+    arrays. The index built by scan_frames is cached in tfrecord_dir and
+    reused as long as none of the scanned directories changed and it was
+    built with the same file matching settings."""
+    dirs = [
+        config.depth_dir, config.label_dir, config.pixel_label_dir,
+        config.occlusion_dir]
+    dir_mtimes = np.asarray([
+        os.stat(d).st_mtime if d is not None and os.path.isdir(d) else -1
+        for d in dirs])
+    settings = json.dumps({
+        'use_pixel_xy': config.use_pixel_xy,
+        'depth_regex': config.depth_regex,
+        'drop_incomplete_frames': config.drop_incomplete_frames,
+        'image_extension': config.image_extension,
+        'label_extension': config.label_extension,
+        'occlusion_extension': config.occlusion_extension
+    }, sort_keys=True)
+    cache_path = os.path.join(config.tfrecord_dir, config.frame_index)
+    index = None
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if np.array_equal(cache['dirs'], np.asarray(dirs, dtype=str)) and \
+                np.array_equal(cache['dir_mtimes'], dir_mtimes) and \
+                'settings' in cache.files and \
+                str(cache['settings']) == settings:
+            print 'Using cached frame index: %s' % cache_path
+            index = dict((k, cache[k]) for k in cache.files)
+    if index is None:
+        index = scan_frames(config)
+        if not os.path.exists(config.tfrecord_dir):
+            os.makedirs(config.tfrecord_dir)
+        np.savez(
+            cache_path,
+            dirs=np.asarray(dirs, dtype=str),
+            dir_mtimes=dir_mtimes,
+            settings=settings,
+            **index)
+    return (
+        index['depth_files'],
+        index['label_files'],
+        index.get('pixel_label_files', None),
+        index.get('occlusion_files', None))
 
 
 def process_data(config):
     """Extract nearest neighbor features from depth images.
     Eventually move this into the tensorflow graph and handle
     depth files/ label files in batches. Also directly add
-    images into a tfrecord instead of into a numpy array."""
-    depth_files = get_files(config.depth_dir, config.depth_regex)
-    label_files = np.asarray([  # replace the depth dir with label dir
-        os.path.join(
-            config.label_dir,
-            re.split(
-                config.image_extension,
-                re.split('/', x)[-1])[0] + config.label_extension)
-        for x in depth_files])
-    pixel_label_files = np.asarray([  # replace the depth dir with label dir
-        os.path.join(
-            config.pixel_label_dir,
-            re.split(
-                config.image_extension,
-                re.split('/', x)[-1])[0] + config.label_extension)
-        for x in depth_files])
-    occlusion_files = np.asarray([  # replace the depth dir with label dir
-        os.path.join(
-            config.occlusion_dir,
-            re.split(
-                config.image_extension,
-                re.split('/', x)[-1])[0] + config.occlusion_extension)
-        for x in depth_files])
-    if not os.path.isfile(occlusion_files[0]):
-        occlusion_files = None
+    images into a tfrecord instead of into a numpy array.
+    Only frames missing from the ingestion manifest are encoded."""
+    depth_files, label_files, pixel_label_files, occlusion_files = \
+        get_frame_index(config)
+    if config.dataset_backend == 'memmap':
+        return create_memmap_dataset(
+            depth_files=depth_files,
+            label_files=label_files,
+            pixel_label_files=pixel_label_files,
+            occlusion_files=occlusion_files,
+            config=config)
+
+    # Skip everything that a previous run already encoded
+    if not os.path.exists(config.tfrecord_dir):
+        os.makedirs(config.tfrecord_dir)
+    manifest = load_manifest(config)
+    clean_tfrecord_dir(manifest, config)
+    header = get_dataset_header(config)
+    if len(manifest['shards']):
+        old_header = read_dataset_header(
+            config.tfrecord_dir, config.dataset_header)
+        if old_header != header:
+            raise RuntimeError(
+                'Existing tfrecords were written as %s but config asks '
+                'for %s. Set rebuild_tfrecords to re-encode them.' % (
+                    old_header, header))
+    write_dataset_header(config.tfrecord_dir, config.dataset_header, header)
+    file_stats = get_file_stats(depth_files)
+    new_mask = get_new_frames(depth_files, file_stats, manifest)
+    print 'Found %s new frames (%s already encoded)' % (
+        new_mask.sum(), len(new_mask) - new_mask.sum())
+    if not new_mask.any():
+        return
+    if pixel_label_files is not None:
+        pixel_label_files = pixel_label_files[new_mask]
+    if occlusion_files is not None:
+        occlusion_files = occlusion_files[new_mask]
+
     # Extract directly into a tfrecord
-    mean_dict = extract_depth_features_into_tfrecord(
-        depth_files=depth_files,
-        label_files=label_files,
+    extract_depth_features_into_tfrecord(
+        depth_files=depth_files[new_mask],
+        label_files=label_files[new_mask],
         pixel_label_files=pixel_label_files,
         occlusion_files=occlusion_files,
+        file_stats=file_stats,
+        manifest=manifest,
         config=config)
-    np.savez(
-        os.path.join(config.tfrecord_dir, config.mean_file),
-        data=mean_dict,
-        **mean_dict)
-
@@ -0,0 +1,151 @@
+import os
+import copy
+import numpy as np
+
+
+def merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """Chan et al. parallel update of (count, mean, sum of squared
+    deviations). Works elementwise on arrays as well as scalars."""
+    count = count_a + count_b
+    if count == 0:
+        return count, mean_a, m2_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (float(count_b) / count)
+    m2 = m2_a + m2_b + delta ** 2 * (float(count_a) * count_b / count)
+    return count, mean, m2
+
+
+class DatasetStats(object):
+    """One-pass statistics of the frames written into a tfrecord split.
+
+    Depth moments and min/max are taken over foreground (non-zero) pixels
+    of the depth channel the loader keeps. The per-pixel mean image covers
+    every pixel. Joint moments are per label coordinate and occlusion_rate
+    is the fraction of frames in which each joint is occluded (occlusion
+    files store visibility flags).
+    Instances from different workers are combined with merge()."""
+
+    def __init__(self):
+        self.num_frames = 0
+        self.depth_count = 0
+        self.depth_mean = 0.
+        self.depth_m2 = 0.
+        self.depth_min = np.inf
+        self.depth_max = -np.inf
+        self.image_sum = None
+        self.joint_mean = None
+        self.joint_m2 = None
+        self.num_occlusions = 0
+        self.occlusion_sum = None
+
+    def update(self, depth_image, label, occlusion=None):
+        """Adds one frame. depth_image is [h, w] or [h, w, c]; only the
+        first channel is used."""
+        if depth_image.ndim == 3:
+            depth_image = depth_image[:, :, 0]
+        depth_image = depth_image.astype(np.float64)
+        label = np.asarray(label, dtype=np.float64).ravel()
+
+        # Foreground depth moments
+        foreground = depth_image[depth_image > 0]
+        if len(foreground):
+            self.depth_count, self.depth_mean, self.depth_m2 = merge_moments(
+                self.depth_count, self.depth_mean, self.depth_m2,
+                len(foreground), foreground.mean(), foreground.var() * len(
+                    foreground))
+            self.depth_min = min(self.depth_min, foreground.min())
+            self.depth_max = max(self.depth_max, foreground.max())
+
+        # Per-pixel mean image
+        if self.image_sum is None:
+            self.image_sum = np.zeros_like(depth_image)
+        self.image_sum += depth_image
+
+        # Per-coordinate joint moments (Welford)
+        if self.joint_mean is None:
+            self.joint_mean = np.zeros_like(label)
+            self.joint_m2 = np.zeros_like(label)
+        self.num_frames += 1
+        delta = label - self.joint_mean
+        self.joint_mean += delta / self.num_frames
+        self.joint_m2 += delta * (label - self.joint_mean)
+
+        if occlusion is not None:
+            occlusion = np.asarray(occlusion, dtype=np.float64).ravel()
+            if self.occlusion_sum is None:
+                self.occlusion_sum = np.zeros_like(occlusion)
+            self.occlusion_sum += occlusion
+            self.num_occlusions += 1
+
+    def merge(self, other):
+        """Folds the statistics of another DatasetStats into this one."""
+        if other.num_frames == 0:
+            return self
+        if self.num_frames == 0:
+            self.__dict__.update(copy.deepcopy(other.__dict__))
+            return self
+        self.depth_count, self.depth_mean, self.depth_m2 = merge_moments(
+            self.depth_count, self.depth_mean, self.depth_m2,
+            other.depth_count, other.depth_mean, other.depth_m2)
+        self.depth_min = min(self.depth_min, other.depth_min)
+        self.depth_max = max(self.depth_max, other.depth_max)
+        self.image_sum += other.image_sum
+        self.num_frames, self.joint_mean, self.joint_m2 = merge_moments(
+            self.num_frames, self.joint_mean, self.joint_m2,
+            other.num_frames, other.joint_mean, other.joint_m2)
+        if other.occlusion_sum is not None:
+            if self.occlusion_sum is None:
+                self.occlusion_sum = np.zeros_like(other.occlusion_sum)
+            self.occlusion_sum += other.occlusion_sum
+            self.num_occlusions += other.num_occlusions
+        return self
+
+    def summary(self):
+        """Normalization constants derived from the running moments."""
+        out = {
+            'num_frames': self.num_frames,
+            'depth_mean': self.depth_mean,
+            'depth_std': np.sqrt(self.depth_m2 / max(self.depth_count, 1)),
+            'depth_min': self.depth_min,
+            'depth_max': self.depth_max,
+        }
+        if self.num_frames:
+            out['mean_image'] = self.image_sum / self.num_frames
+            out['joint_mean'] = self.joint_mean
+            out['joint_std'] = np.sqrt(self.joint_m2 / self.num_frames)
+        if self.num_occlusions:
+            out['occlusion_rate'] = \
+                1. - self.occlusion_sum / self.num_occlusions
+        return out
+
+    def save(self, path):
+        """Writes the raw moments (so the file can be merged again) and the
+        derived summary to an npz sidecar."""
+        state = dict(
+            (k, v) for k, v in self.__dict__.items() if v is not None)
+        summary = dict(
+            ('summary_' + k, v) for k, v in self.summary().items())
+        state.update(summary)
+        np.savez(path, **state)
+
+    @classmethod
+    def load(cls, path):
+        stats = cls()
+        data = np.load(path)
+        for k in data.files:
+            if not k.startswith('summary_'):
+                value = data[k]
+                setattr(stats, k, value[()] if value.ndim == 0 else value)
+        return stats
+
+
+def get_stats_path(tfrecord_dir, stats_name, split):
+    return os.path.join(tfrecord_dir, '%s_%s.npz' % (stats_name, split))
+
+
+def load_dataset_stats(tfrecord_dir, stats_name, split='train'):
+    """Summary statistics of a split, or None if it has no sidecar."""
+    stats_path = get_stats_path(tfrecord_dir, stats_name, split)
+    if not os.path.exists(stats_path):
+        return None
+    return DatasetStats.load(stats_path).summary()
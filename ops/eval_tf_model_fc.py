@@ -53,7 +53,8 @@ def eval_model(config):
             model_input_shape=config.resize,
             train=config.data_augmentations,
             num_epochs=config.epochs,
-            feat_mean_value=feat_mean)
+            feat_mean_value=feat_mean,
+            compression=config.tfrecord_compression)
         val_images, val_labels = inputs(
             tfrecord_file=validation_data,
             batch_size=1,
@@ -64,7 +65,8 @@ def eval_model(config):
             model_input_shape=config.resize,
             train=config.data_augmentations,
             num_epochs=config.epochs,
-            feat_mean_value=feat_mean)
+            feat_mean_value=feat_mean,
+            compression=config.tfrecord_compression)
         tf.summary.image('validation images', tf.cast(val_labels, tf.float32))
 
     # Prepare model on GPU
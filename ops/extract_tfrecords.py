@@ -1,9 +1,10 @@
 from PIL import Image
 import numpy as np
 import tensorflow as tf
+from ops.utils import get_tfrecord_options
 
-def read_and_decode(filename_queue):
-   reader = tf.TFRecordReader()
+def read_and_decode(filename_queue, compression=None):
+   reader = tf.TFRecordReader(options=get_tfrecord_options(compression))
    _, serialized_example = reader.read(filename_queue)
    features = tf.parse_single_example(
       serialized_example,
@@ -20,13 +21,13 @@ def read_and_decode(filename_queue):
    return image, label, feat
 
 
-def get_records(FILE, config):
+def get_records(FILE, config, compression=None):
    ims = []
    labs = []
    feats = []
    with tf.Session() as sess:
        filename_queue = tf.train.string_input_producer([ FILE ])
-       image, label, feat = read_and_decode(filename_queue)
+       image, label, feat = read_and_decode(filename_queue, compression)
        image = tf.reshape(image, tf.stack(config.resize))
        init_op = tf.global_variables_initializer()
        sess.run(init_op)
@@ -0,0 +1,118 @@
+import time
+import numpy as np
+import tensorflow as tf
+from collections import deque, OrderedDict
+
+
+def get_time():
+    # py_func needs a Python function: TF 1.15 cannot weak-reference the
+    # time.time builtin
+    return time.time()
+
+
+def add_input_timer(tensors):
+    """Seconds a step waits for tensors (the dequeued batch). A py_func
+    timestamp without inputs fires as soon as the step starts and a second
+    one fires once tensors are available."""
+    start = tf.py_func(get_time, [], tf.float64, stateful=True)
+    with tf.control_dependencies(tensors + [start]):
+        end = tf.py_func(get_time, [], tf.float64, stateful=True)
+    return tf.cast(end - start, tf.float32)
+
+
+def add_completion_timer(ops):
+    """Timestamp (time.time()) taken once ops have run."""
+    with tf.control_dependencies(ops):
+        return tf.py_func(get_time, [], tf.float64, stateful=True)
+
+
+def get_input_queues():
+    """The queue runners of the graph that feed the inputs, keyed by queue
+    name in pipeline order (upstream first), with their capacity. Filename
+    and index producer queues are left out."""
+    queues = OrderedDict()
+    for qr in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS):
+        if 'input_producer' in qr.name:
+            continue
+        capacity = qr.queue.queue_ref.op.get_attr('capacity')
+        queues[qr.queue.name] = (qr, capacity)
+    return queues
+
+
+def get_queue_fill_levels():
+    """Fraction full of every input queue, keyed by queue name."""
+    return OrderedDict(
+        (name, tf.cast(qr.queue.size(), tf.float32) / max(capacity, 1))
+        for name, (qr, capacity) in get_input_queues().items())
+
+
+class QueueAutotuner(object):
+    """Adds enqueue threads to the input queues while the model waits on
+    input. Every interval steps the mean input wait is compared with the
+    mean step time; above wait_threshold one more thread is started on the
+    most upstream queue that is less than half full (the stage the step is
+    starving on), up to max_threads extra threads. The chosen thread counts
+    are printed so they can be pinned in config. Spare queue runners are
+    built up front so the graph does not grow once the session runs.
+
+    Only queue runners are tuned. The tf.data pipeline has none, so extra
+    threads add no read parallelism there and do not change its prefetch
+    depth (see num_parallel_calls and prefetch_batches)."""
+
+    def __init__(
+            self,
+            max_threads=32,
+            interval=50,
+            wait_threshold=0.1):
+        self.interval = interval
+        self.wait_threshold = wait_threshold
+        self.max_threads = max_threads
+        self.queues = get_input_queues()
+        self.fill_levels = get_queue_fill_levels()
+        # A QueueRunner starts its threads once per session, so keep one
+        # spare runner per potential thread, cycling over the enqueue ops
+        self.spares = dict(
+            (name, [
+                tf.train.QueueRunner(
+                    qr.queue, [qr.enqueue_ops[i % len(qr.enqueue_ops)]])
+                for i in range(max_threads)])
+            for name, (qr, _) in self.queues.items())
+        self.extra_threads = dict((name, 0) for name in self.queues)
+        self.threads = []
+        self.waits = deque(maxlen=interval)
+        self.durations = deque(maxlen=interval)
+        self.settled = len(self.queues) == 0
+
+    def get_wait_fraction(self):
+        return np.sum(self.waits) / max(np.sum(self.durations), 1e-8)
+
+    def update(self, sess, coord, input_wait, duration, step):
+        """Records one step and, every interval steps, adds a thread if the
+        step was input bound. Returns the new threads (to join)."""
+        self.waits.append(input_wait)
+        self.durations.append(duration)
+        if self.settled or step == 0 or step % self.interval:
+            return []
+        wait_fraction = self.get_wait_fraction()
+        if wait_fraction < self.wait_threshold or \
+                sum(self.extra_threads.values()) >= self.max_threads:
+            self.settled = True
+            print 'Autotune: settled with %.1f%% of step time waiting on ' \
+                'input. Extra enqueue threads: %s' % (
+                    100 * wait_fraction, self.extra_threads)
+            return []
+        fills = sess.run(self.fill_levels)
+        underfilled = [k for k in self.fill_levels if fills[k] < 0.5]
+        if len(underfilled):
+            name = underfilled[0]
+        else:
+            name = min(fills, key=fills.get)
+        threads = self.spares[name].pop().create_threads(
+            sess, coord=coord, start=True)
+        self.extra_threads[name] += 1
+        self.threads += threads
+        print 'Autotune: %.1f%% of step time waiting on input, queue %s ' \
+            'is %.0f%% full. Started enqueue thread %s on it.' % (
+                100 * wait_fraction, name, 100 * fills[name],
+                self.extra_threads[name])
+        return threads
@@ -0,0 +1,52 @@
+import numpy as np
+
+
+class PlateauMonitor(object):
+    """Decays the learning rate and stops training when a score (lower is
+    better, checked once per validation round) stops improving.
+
+    A round improves on the best score when it is lower by more than
+    threshold (relative). After every patience rounds without improvement
+    the learning rate is multiplied by decay_factor, down to min_lr; a
+    plateau at min_lr, or stop_rounds rounds without improvement, stops
+    training. best and bad_rounds are the state to resume from."""
+
+    def __init__(
+            self,
+            patience=5,
+            decay_factor=0.1,
+            min_lr=1e-6,
+            stop_rounds=100,
+            threshold=1e-3,
+            best=None,
+            bad_rounds=0):
+        self.patience = patience
+        self.decay_factor = decay_factor
+        self.min_lr = min_lr
+        self.stop_rounds = stop_rounds
+        self.threshold = threshold
+        self.best = best
+        self.bad_rounds = bad_rounds
+
+    def update(self, score, lr):
+        """Records one round. Returns (new learning rate, stop, decision)
+        where decision describes what happened, for the log."""
+        if self.best is None or not np.isfinite(self.best) or \
+                score < self.best - self.threshold * abs(self.best):
+            self.best = score
+            self.bad_rounds = 0
+            return lr, False, 'improved to %g' % score
+        self.bad_rounds += 1
+        status = 'no improvement on %g for %s rounds' % (
+            self.best, self.bad_rounds)
+        if self.bad_rounds >= self.stop_rounds:
+            return lr, True, '%s: stopping' % status
+        if self.bad_rounds % self.patience == 0:
+            # lr comes back from a float32 variable
+            if lr <= self.min_lr * (1 + 1e-6):
+                return lr, True, '%s at the minimum learning rate %g: ' \
+                    'stopping' % (status, lr)
+            new_lr = max(lr * self.decay_factor, self.min_lr)
+            return new_lr, False, '%s: learning rate %g -> %g' % (
+                status, lr, new_lr)
+        return lr, False, status
@@ -30,7 +30,8 @@ def train_and_eval(config):
 
     # TFLearn doesn't support tfrecords; extract them by hand for now
     img, label, feat = get_records(
-        os.path.join(config.tfrecord_dir, 'train.tfrecords'))
+        os.path.join(config.tfrecord_dir, 'train.tfrecords'), config,
+        compression=config.tfrecord_compression)
     model.fit(
         x=feat, y=label,
         batch_size=config.batch_size, monitors=[monitor])
@@ -41,7 +42,8 @@ def train_and_eval(config):
                 prediction_key=eval_metrics.get_prediction_key(metric_name))}
 
     test_img, test_label, test_feat = get_records(
-        os.path.join(config.tfrecord_dir, 'val.tfrecords'))
+        os.path.join(config.tfrecord_dir, 'val.tfrecords'), config,
+        compression=config.tfrecord_compression)
     results = model.evaluate(
         x=test_img, y=test_label,
         batch_size=config.batch_size, metrics=metric)
@@ -12,12 +12,14 @@ def train_and_eval(config):
         max_leaf_nodes=config.max_nodes)
 
     img, label, feat = get_records(
-        os.path.join(config.tfrecord_dir, 'train.tfrecords'), config)
+        os.path.join(config.tfrecord_dir, 'train.tfrecords'), config,
+        compression=config.tfrecord_compression)
     model.fit(
         x=feat, y=label)
 
     test_img, test_label, test_feat = get_records(
-        os.path.join(config.tfrecord_dir, 'val.tfrecords'), config)
+        os.path.join(config.tfrecord_dir, 'val.tfrecords'), config,
+        compression=config.tfrecord_compression)
     results = model.predict(
         x=test_img, y=test_label)
     return results, model
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import tensorflow as tf
+from collections import deque
+from tensorflow.python.client import timeline
+
+
+class StepProfiler(object):
+    """Splits training steps into phases and keeps a rolling window of them.
+
+    For one sess.run that started at run_start and returned at run_end:
+    input wait is the in-graph wait for the batch (add_input_timer),
+    compute runs until the step's ops finished (compute_done, from
+    add_completion_timer) and transfer is the rest, i.e. copying the
+    fetches to the host and returning them. Every trace_steps steps (half
+    way between validations, so the trace shows an ordinary step) a full
+    RunMetadata trace is captured instead and written as a Chrome trace
+    (chrome://tracing) to summary_dir and to the TensorBoard graph."""
+
+    def __init__(self, summary_dir, window=500, trace_steps=1000):
+        self.summary_dir = summary_dir
+        self.trace_steps = trace_steps
+        self.phases = dict(
+            (k, deque(maxlen=window))
+            for k in ['step', 'input wait', 'compute', 'transfer'])
+
+    def get_run_options(self, step):
+        """(options, run_metadata) for sess.run: a full trace on trace
+        steps, (None, None) otherwise."""
+        if self.trace_steps is None or \
+                step % self.trace_steps != self.trace_steps // 2:
+            return None, None
+        return tf.RunOptions(
+            trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def record(self, run_start, run_end, input_wait, compute_done):
+        """Adds one untraced step. Returns its phases in seconds."""
+        phases = {
+            'step': run_end - run_start,
+            'input wait': input_wait,
+            'compute': max(compute_done - run_start - input_wait, 0.),
+            'transfer': max(run_end - compute_done, 0.)
+        }
+        for k, v in phases.items():
+            self.phases[k].append(v)
+        return phases
+
+    def save_trace(self, step, run_metadata, summary_writer=None):
+        trace = timeline.Timeline(run_metadata.step_stats)
+        trace_path = os.path.join(
+            self.summary_dir, 'timeline_%s.json' % step)
+        with open(trace_path, 'w') as f:
+            f.write(trace.generate_chrome_trace_format())
+        if summary_writer is not None:
+            summary_writer.add_run_metadata(run_metadata, 'step_%s' % step)
+        print 'Saved a trace of step %s to %s' % (step, trace_path)
+
+    def get_summary_values(self):
+        """tf.Summary values: p50/p95/p99 step time and the mean of every
+        phase over the window."""
+        if not len(self.phases['step']):
+            return []
+        step_times = np.asarray(self.phases['step'])
+        values = [
+            tf.Summary.Value(
+                tag='profile/step seconds p%s' % p,
+                simple_value=np.percentile(step_times, p))
+            for p in [50, 95, 99]]
+        values += [
+            tf.Summary.Value(
+                tag='profile/%s seconds' % k, simple_value=np.mean(v))
+            for k, v in self.phases.items() if k != 'step']
+        return values
+
+    def get_breakdown(self):
+        """Share of the mean step time spent in each phase."""
+        if not len(self.phases['step']):
+            return dict((k, 0.) for k in self.phases if k != 'step')
+        total = max(np.mean(self.phases['step']), 1e-8)
+        return dict(
+            (k, np.mean(v) / total)
+            for k, v in self.phases.items() if k != 'step')
@@ -106,6 +106,13 @@ def regression_mse(pred, targets):
     return tf.reduce_mean(tf.square(pred - targets))
 
 
+def weighted_l2_loss(x, weights=None):
+    """tf.nn.l2_loss with every row of x scaled by weights ([batch])."""
+    if weights is None:
+        return tf.nn.l2_loss(x)
+    return tf.reduce_sum(tf.expand_dims(weights, 1) * tf.square(x)) / 2
+
+
 def tf_confusion_matrix(pred, targets):
     return tf.contrib.metrics.confusion_matrix(pred, targets)
 
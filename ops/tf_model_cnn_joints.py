@@ -1,13 +1,28 @@
 import os
 import re
+import json
 import time
 from datetime import datetime
 import numpy as np
 import tensorflow as tf
-from ops.data_loader_joints import inputs
+from functools import partial
+from ops.data_loader_joints import inputs, dataset_inputs, AUGMENTATIONS, \
+    get_normalization_params
+from ops.data_loader_memmap import inputs as memmap_inputs, \
+    MemmapDataset, HardExampleSampler
 from ops.tf_fun import regression_mse, correlation, make_dir, \
-    fine_tune_prepare_layers, ft_optimizer_list, softmax_cost
-from ops.utils import get_dt
+    fine_tune_prepare_layers, ft_optimizer_list, softmax_cost, \
+    weighted_l2_loss
+from ops.utils import get_dt, read_dataset_header, AsyncWriter
+from ops.checkpoint_manager import CheckpointManager, get_checkpoint_step, \
+    restore_checkpoint
+from ops.dataset_stats import load_dataset_stats
+from ops.data_loader_validation import get_validation_set, \
+    evaluate_validation_set
+from ops.plateau_monitor import PlateauMonitor
+from ops.input_monitor import add_input_timer, get_queue_fill_levels, \
+    QueueAutotuner, add_completion_timer
+from ops.step_profiler import StepProfiler
 
 
 def train_and_eval(config):
@@ -52,47 +67,238 @@ def train_and_eval(config):
     [make_dir(d) for d in dir_list]
 
     # Prepare model inputs
-    train_data = os.path.join(config.tfrecord_dir, config.train_tfrecords)
-    validation_data = os.path.join(config.tfrecord_dir, config.val_tfrecords)
+    if config.dataset_backend == 'memmap':
+        print 'Reading memmaps from: %s' % config.memmap_dir
+        data_dir = config.memmap_dir
+        dataset_header = None
+    else:
+        if config.use_normalized_tfrecords:
+            data_dir = config.normalized_tfrecord_dir
+        else:
+            data_dir = config.tfrecord_dir
+        dataset_header = read_dataset_header(
+            data_dir, config.dataset_header)
+        print 'Reading tfrecords format version %s (%s depth) from: %s' % (
+            dataset_header['format_version'],
+            dataset_header['depth_encoding'],
+            data_dir)
+        if dataset_header.get('prenormalized', False):
+            normalization = get_normalization_params(
+                train=config.data_augmentations,
+                image_target_size=config.image_target_size,
+                image_input_size=config.image_input_size,
+                max_value=config.max_depth,
+                normalize_labels=config.normalize_labels)
+            # Round trip through json to compare lists with lists
+            if json.loads(json.dumps(normalization)) != \
+                    dataset_header['normalization']:
+                raise RuntimeError(
+                    'The tfrecords in %s were normalized with %s but config '
+                    'asks for %s. Re-export them.' % (
+                        data_dir, dataset_header['normalization'],
+                        normalization))
+        if dataset_header.get(
+                'max_depth', config.max_depth) != config.max_depth:
+            raise RuntimeError(
+                'The tfrecords were quantized with max_depth %s but config '
+                'uses %s.' % (dataset_header['max_depth'], config.max_depth))
+    train_data = os.path.join(data_dir, config.train_tfrecords)
+    validation_data = os.path.join(data_dir, config.val_tfrecords)
+    train_stats = load_dataset_stats(
+        data_dir, config.dataset_stats, 'train')
+    if train_stats is not None:
+        print 'Training set: %s frames, foreground depth %.1f +/- %.1f ' \
+            '(range %.1f-%.1f)' % (
+                train_stats['num_frames'], train_stats['depth_mean'],
+                train_stats['depth_std'], train_stats['depth_min'],
+                train_stats['depth_max'])
+        if train_stats['depth_max'] > config.max_depth:
+            print 'Warning: depths up to %.1f exceed max_depth %s.' % (
+                train_stats['depth_max'], config.max_depth)
+
+    # Batched augmentations of the training inputs
+    if any(a in config.data_augmentations for a in AUGMENTATIONS):
+        augmentation = {
+            'joint_order': config.joint_order,
+            'max_rotation': config.max_rotation,
+            'max_shift': config.max_shift,
+            'depth_jitter': config.depth_jitter
+        }
+    else:
+        augmentation = None
+
+    # A resumed run continues from the step of its checkpoint and its inputs
+    # only produce the epochs that are left. The interrupted epoch restarts
+    # as a fresh shuffle that is cut off at the original total step count.
+    num_epochs, start_step, max_steps = config.epochs, 0, None
+    if config.resume_from_checkpoint is not None:
+        start_step = get_checkpoint_step(config.resume_from_checkpoint)
+    if start_step and train_stats is not None:
+        steps_per_epoch = train_stats['num_frames'] / float(
+            config.train_batch)
+        max_steps = int(config.epochs * steps_per_epoch)
+        num_epochs = config.epochs - int(start_step // steps_per_epoch)
+        if start_step >= max_steps:
+            raise RuntimeError(
+                '%s already trained all %s epochs (%s steps).' % (
+                    config.resume_from_checkpoint, config.epochs, max_steps))
+        print 'Resuming at step %s: epoch %s of %s' % (
+            start_step, config.epochs - num_epochs + 1, config.epochs)
+    elif start_step:
+        print 'Warning: no dataset_stats to count the training frames, so ' \
+            'the resumed run trains %s more epochs.' % config.epochs
+
+    # Loss-aware sampling of the training frames
+    if config.hard_example_sampling:
+        if config.dataset_backend != 'memmap':
+            raise RuntimeError(
+                'Hard-example sampling needs random access to the frames. '
+                'Set dataset_backend to \'memmap\'.')
+        sampler = HardExampleSampler(
+            MemmapDataset(config.memmap_dir, 'train'),
+            alpha=config.hard_example_alpha,
+            uniform_mix=config.hard_example_uniform_mix,
+            decay=config.hard_example_decay,
+            occlusion_boost=config.hard_example_occlusion_boost)
+    else:
+        sampler = None
+    train_weights = None
 
     # Prepare data on CPU
     with tf.device('/cpu:0'):
-        train_images, train_labels, train_occlusions = inputs(
-            tfrecord_file=train_data,
-            batch_size=config.train_batch,
-            im_size=config.resize,
-            target_size=config.image_target_size,
-            model_input_shape=config.resize,
-            train=config.data_augmentations,
-            label_shape=config.num_classes,
-            num_epochs=config.epochs,
-            image_target_size=config.image_target_size,
-            image_input_size=config.image_input_size,
-            maya_conversion=config.maya_conversion,
-            max_value=config.max_depth,
-            return_occlusions=config.occlusion_dir,
-            normalize_labels=config.normalize_labels
-            )
-        val_images, val_labels, val_occlusions = inputs(
-            tfrecord_file=validation_data,
-            batch_size=config.validation_batch,
-            im_size=config.resize,
-            target_size=config.image_target_size,
-            model_input_shape=config.resize,
-            train=config.data_augmentations,
-            label_shape=config.num_classes,
-            num_epochs=config.epochs,
-            image_target_size=config.image_target_size,
-            image_input_size=config.image_input_size,
-            maya_conversion=config.maya_conversion,
-            max_value=config.max_depth,
-            return_occlusions=config.occlusion_dir,
-            normalize_labels=config.normalize_labels
-            )
+        if config.dataset_backend == 'memmap':
+            train_inputs = memmap_inputs(
+                memmap_dir=config.memmap_dir,
+                split='train',
+                batch_size=config.train_batch,
+                label_shape=config.num_classes,
+                image_target_size=config.image_target_size,
+                image_input_size=config.image_input_size,
+                return_occlusions=config.occlusion_dir,
+                train=config.data_augmentations,
+                max_value=config.max_depth,
+                num_epochs=num_epochs,
+                normalize_labels=config.normalize_labels,
+                augmentation=augmentation,
+                sampler=sampler
+                )
+            train_images, train_labels, train_occlusions = train_inputs[:3]
+            if sampler is not None:
+                train_idx, train_weights = train_inputs[3:]
+            if not config.full_validation:
+                val_images, val_labels, val_occlusions = memmap_inputs(
+                    memmap_dir=config.memmap_dir,
+                    split='val',
+                    batch_size=config.validation_batch,
+                    label_shape=config.num_classes,
+                    image_target_size=config.image_target_size,
+                    image_input_size=config.image_input_size,
+                    return_occlusions=config.occlusion_dir,
+                    train=config.data_augmentations,
+                    max_value=config.max_depth,
+                    num_epochs=config.epochs,
+                    normalize_labels=config.normalize_labels
+                    )
+        else:
+            if config.input_pipeline == 'dataset':
+                tfrecord_inputs = partial(
+                    dataset_inputs,
+                    num_parallel_calls=config.num_parallel_calls,
+                    prefetch_batches=config.prefetch_batches,
+                    batch_decode=config.batch_decode)
+            else:
+                tfrecord_inputs = partial(
+                    inputs, batch_decode=config.batch_decode)
+            train_images, train_labels, train_occlusions = tfrecord_inputs(
+                tfrecord_file=train_data,
+                batch_size=config.train_batch,
+                im_size=config.resize,
+                target_size=config.image_target_size,
+                model_input_shape=config.resize,
+                train=config.data_augmentations,
+                label_shape=config.num_classes,
+                num_epochs=num_epochs,
+                image_target_size=config.image_target_size,
+                image_input_size=config.image_input_size,
+                maya_conversion=config.maya_conversion,
+                max_value=config.max_depth,
+                return_occlusions=config.occlusion_dir,
+                normalize_labels=config.normalize_labels,
+                num_readers=config.num_readers,
+                depth_encoding=dataset_header['depth_encoding'],
+                cropped=dataset_header.get('crop_to_monkey', False),
+                compression=dataset_header.get('compression'),
+                augmentation=augmentation,
+                prenormalized=dataset_header.get('prenormalized', False)
+                )
+            if not config.full_validation:
+                val_images, val_labels, val_occlusions = tfrecord_inputs(
+                    tfrecord_file=validation_data,
+                    batch_size=config.validation_batch,
+                    im_size=config.resize,
+                    target_size=config.image_target_size,
+                    model_input_shape=config.resize,
+                    train=config.data_augmentations,
+                    label_shape=config.num_classes,
+                    num_epochs=config.epochs,
+                    image_target_size=config.image_target_size,
+                    image_input_size=config.image_input_size,
+                    maya_conversion=config.maya_conversion,
+                    max_value=config.max_depth,
+                    return_occlusions=config.occlusion_dir,
+                    normalize_labels=config.normalize_labels,
+                    num_readers=config.num_readers,
+                    depth_encoding=dataset_header['depth_encoding'],
+                    cropped=dataset_header.get('crop_to_monkey', False),
+                    compression=dataset_header.get('compression'),
+                    prenormalized=dataset_header.get('prenormalized', False)
+                    )
         tf.summary.image(
             'train images', tf.cast(train_images, tf.float32))
-        tf.summary.image(
-            'validation images', tf.cast(val_images, tf.float32))
+
+        # Input pipeline monitoring
+        input_wait = add_input_timer([train_images, train_labels])
+        queue_fills = get_queue_fill_levels()
+        if config.input_autotune:
+            autotuner = QueueAutotuner(
+                max_threads=config.autotune_max_threads,
+                interval=config.autotune_interval,
+                wait_threshold=config.autotune_wait_threshold)
+            if autotuner.settled:
+                print 'Autotune: no input queues to tune.'
+        else:
+            autotuner = None
+        if config.full_validation:
+            # Decoded once and fed in fixed-size batches
+            val_set = get_validation_set(
+                config, dataset_header, tfrecord_dir=data_dir)
+            val_images = tf.placeholder(
+                tf.float32,
+                [config.full_validation_batch] +
+                config.image_target_size[:2] + [1],
+                name='val_images')
+        else:
+            tf.summary.image(
+                'validation images', tf.cast(val_images, tf.float32))
+
+    # Training state that is saved with (and restored from) checkpoints
+    with tf.device('/cpu:0'):
+        global_step = tf.Variable(
+            0, trainable=False, name='global_step', dtype=tf.int64)
+        learning_rate = tf.Variable(
+            config.lr, trainable=False, name='learning_rate',
+            dtype=tf.float32)
+        plateau_best = tf.Variable(
+            np.inf, trainable=False, name='plateau_best', dtype=tf.float32)
+        plateau_rounds = tf.Variable(
+            0, trainable=False, name='plateau_rounds', dtype=tf.int64)
+        schedule_values = {
+            learning_rate: tf.placeholder(tf.float32, []),
+            plateau_best: tf.placeholder(tf.float32, []),
+            plateau_rounds: tf.placeholder(tf.int64, [])
+        }
+        update_schedule = tf.group(*[
+            v.assign(ph) for v, ph in schedule_values.items()])
 
     with tf.device('/gpu:0'):
         with tf.variable_scope('cnn') as scope:
@@ -108,30 +314,46 @@ def train_and_eval(config):
                 batchnorm=config.batch_norm)
 
             # Prepare the loss functions:::
+            # (frames are scaled by their importance weights when sampled
+            # by loss)
             loss_list, loss_label = [], []
             # 1. High-res head
             if config.model_type == 'cnn_multiscale_low_high_res_mid_loss':
-                loss_list += [tf.nn.l2_loss(
-                    model.high_feature_encoder_joints - train_labels)]
+                loss_list += [weighted_l2_loss(
+                    model.high_feature_encoder_joints - train_labels,
+                    train_weights)]
                 loss_label += ['high-res head']
                 # 2. Low-res head
-                loss_list += [tf.nn.l2_loss(
-                    model.low_feature_encoder_joints - train_labels)]
+                loss_list += [weighted_l2_loss(
+                    model.low_feature_encoder_joints - train_labels,
+                    train_weights)]
                 loss_label += ['low-res head']
             # 3. Combined head loss -- joints
-            loss_list += [tf.nn.l2_loss(
-                model.fc8 - train_labels)]
+            loss_list += [weighted_l2_loss(
+                model.fc8 - train_labels, train_weights)]
             loss_label += ['combined head']
             # 4. Combined head loss -- occlusions
             # loss_list += [tf.nn.l2_loss(
             #     model.fc8_occlusion - train_occlusions)]
-            loss_list += [tf.reduce_mean(
-                tf.nn.sigmoid_cross_entropy_with_logits(
-                    labels=train_occlusions,
-                    logits=model.fc8_occlusion))]
+            occlusion_loss = tf.nn.sigmoid_cross_entropy_with_logits(
+                labels=train_occlusions,
+                logits=model.fc8_occlusion)
+            if train_weights is not None:
+                loss_list += [tf.reduce_mean(
+                    tf.expand_dims(train_weights, 1) * occlusion_loss)]
+            else:
+                loss_list += [tf.reduce_mean(occlusion_loss)]
             loss_label += ['occlusion head']
             loss = tf.add_n(loss_list)
 
+            # Unweighted loss of every frame, fed back to the sampler
+            if sampler is not None:
+                example_loss = tf.reduce_sum(
+                    tf.square(model.fc8 - train_labels), axis=1) / 2 + \
+                    tf.reduce_mean(occlusion_loss, axis=1)
+                tf.summary.scalar(
+                    'hard example weight', tf.reduce_mean(train_weights))
+
             # Add wd if necessary
             if config.wd_penalty is not None:
                 _, l2_wd_layers = fine_tune_prepare_layers(
@@ -165,7 +387,7 @@ def train_and_eval(config):
 
             # Gradient Descent
             optimizer = optimizer(
-                config.lr)
+                learning_rate)
             # Op to calculate every variable gradient
             # grads = optimizer.compute_gradients(
             #     loss, tf.trainable_variables())
@@ -179,7 +401,8 @@ def train_and_eval(config):
             # [tf.summary.histogram(
             #     var.name + '/gradient', grad)
             #     for grad, var in grads if grad is not None]
-            train_op = optimizer.minimize(loss)
+            train_op = optimizer.minimize(loss, global_step=global_step)
+            compute_done = add_completion_timer([train_op, loss])
 
             # Summarize scores
             train_score, _ = correlation(
@@ -197,12 +420,34 @@ def train_and_eval(config):
                     output_shape=config.num_classes),
 
                 # Calculate validation accuracy
-                val_score = tf.nn.l2_loss(val_model.fc8 - val_labels)
-                tf.summary.scalar("validation mse", val_score)
+                if not config.full_validation:
+                    val_score = tf.nn.l2_loss(val_model.fc8 - val_labels)
+                    tf.summary.scalar("validation mse", val_score)
 
     # Set up summaries and saver
-    saver = tf.train.Saver(
-        tf.global_variables(), max_to_keep=config.keep_checkpoints)
+    # Old checkpoints are deleted by the CheckpointManager
+    saver = tf.train.Saver(tf.global_variables(), max_to_keep=None)
+    if config.async_writes:
+        # Checkpoints are written from a snapshot of the variables in host
+        # memory, so training can update them while the writer saves.
+        # Saved under the original names, so saver restores them.
+        with tf.device('/cpu:0'):
+            shadow_vars = dict(
+                (v.op.name, tf.Variable(
+                    tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+                    trainable=False,
+                    collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                    name='shadow/' + v.op.name))
+                for v in tf.global_variables())
+            snapshot_op = tf.group(*[
+                shadow_vars[v.op.name].assign(v)
+                for v in tf.global_variables()])
+        checkpoint_saver = tf.train.Saver(shadow_vars, max_to_keep=None)
+        writer = AsyncWriter(max_pending=config.max_pending_writes)
+    else:
+        checkpoint_saver = saver
+        writer = None
+    checkpoint_written = None
     summary_op = tf.summary.merge_all()
 
     # Initialize the graph
@@ -217,28 +462,114 @@ def train_and_eval(config):
     coord = tf.train.Coordinator()
     threads = tf.train.start_queue_runners(sess=sess, coord=coord)
 
+    def write(fn, *args, **kwargs):
+        """Hands a file write to the writer thread, or runs it here."""
+        if writer is not None:
+            return writer.put(fn, *args, **kwargs)
+        fn(*args, **kwargs)
+
+    checkpoint_manager = CheckpointManager(
+        config.train_checkpoint,
+        keep_best=config.keep_best_checkpoints,
+        index_name=config.checkpoint_index)
+
+    def save_checkpoint(step, score, metrics):
+        """Saves a checkpoint and keeps it only if it is among the best."""
+        checkpoint_path = checkpoint_saver.save(
+            sess,
+            os.path.join(
+                config.train_checkpoint, 'model_' + str(step) + '.ckpt'),
+            global_step=step)
+        checkpoint_manager.add(step, checkpoint_path, score, metrics)
+
     # Start training loop
     np.save(config.train_checkpoint, config)
-    step, losses = 0, []
+    step, losses = start_step, []
+    input_waits, step_durations = [], []
     train_acc = 0
+    if config.normalize_labels:
+        label_scale = np.asarray(
+            config.image_target_size[:2] + [config.max_depth]).reshape(
+            1, -1).repeat(config.num_classes // 3, axis=0).reshape(1, -1)
+    else:
+        label_scale = None
+
+    # Every step only runs train_op and reads back the loss (with the input
+    # timing and the sampler's per-frame losses). The training correlation
+    # is read on log steps and the image batch and predictions on
+    # validation steps. lean_fetches=False reads everything every step.
+    step_fetches = {
+        'train_op': train_op,
+        'loss': loss,
+        'input_wait': input_wait,
+        'compute_done': compute_done
+    }
+    profiler = StepProfiler(
+        summary_dir=config.summary_dir,
+        window=config.profile_window,
+        trace_steps=config.profile_trace_steps)
+    if sampler is not None:
+        step_fetches['sampler_idx'] = train_idx
+        step_fetches['sampler_loss'] = example_loss
+    log_fetches = {'train_acc': train_score}
+    diagnostic_fetches = {
+        'im': train_images,
+        'yhat': model.fc8,
+        'yhrhat': model.high_feature_encoder_joints,
+        'ylrhat': model.low_feature_encoder_joints,
+        'ytrue': train_labels,
+        'occhat': model.fc8_occlusion,
+        'occtrue': train_occlusions
+    }
     if config.resume_from_checkpoint is not None:
         print 'Resuming training from checkpoint: %s' % config.resume_from_checkpoint
-        saver.restore(sess, config.resume_from_checkpoint)
+        missing = restore_checkpoint(sess, config.resume_from_checkpoint)
+        if len(missing):
+            print 'Not in the checkpoint (left initialized): %s' % ', '.join(
+                v.op.name for v in missing)
+        if global_step in missing:
+            sess.run(global_step.assign(start_step))
+
+    # Plateaus of the validation error (or training loss) decay the
+    # learning rate and stop training
+    lr_value, best, bad_rounds = sess.run(
+        [learning_rate, plateau_best, plateau_rounds])
+    plateau_monitor = PlateauMonitor(
+        patience=config.lr_plateau_rounds,
+        decay_factor=config.lr_decay_factor,
+        min_lr=config.min_lr,
+        stop_rounds=config.early_stopping_rounds,
+        threshold=config.plateau_threshold,
+        best=best if np.isfinite(best) else None,
+        bad_rounds=bad_rounds)
+    print 'Learning rate: %s' % lr_value
+    stop_training = False
     try:
         while not coord.should_stop():
+            if max_steps is not None and step >= max_steps:
+                print('Done training for %d epochs, %d steps.' % (
+                    config.epochs, step))
+                break
             start_time = time.time()
-            _, loss_value, train_acc, im, yhat, yhrhat, ylrhat, ytrue, occhat, occtrue = sess.run([
-                train_op,
-                loss,
-                train_score,
-                train_images,
-                model.fc8,
-                model.high_feature_encoder_joints,
-                model.low_feature_encoder_joints,
-                train_labels,
-                model.fc8_occlusion,
-                train_occlusions
-            ])
+            validation_step = step % config.steps_before_validation == 0
+            log_step = validation_step or step % config.log_steps == 0
+            fetches = dict(step_fetches)
+            if log_step or not config.lean_fetches:
+                fetches.update(log_fetches)
+            if validation_step or not config.lean_fetches:
+                fetches.update(diagnostic_fetches)
+            run_options, run_metadata = profiler.get_run_options(step)
+            out = sess.run(
+                fetches, options=run_options, run_metadata=run_metadata)
+            run_end = time.time()
+            loss_value, wait_value = out['loss'], out['input_wait']
+            if run_metadata is not None:
+                # Tracing slows the step, so it is left out of the window
+                profiler.save_trace(step, run_metadata, summary_writer)
+            else:
+                profiler.record(
+                    start_time, run_end, wait_value, out['compute_done'])
+            train_acc = out.get('train_acc')
             # import scipy.misc
             # np.save('/media/data_cifs/monkey_tracking/batches/test/im', im)
             # np.save('/media/data_cifs/monkey_tracking/batches/test/yhat', yhat)
@@ -246,19 +577,115 @@ def train_and_eval(config):
 
             losses.append(loss_value)
             duration = time.time() - start_time
+            if sampler is not None:
+                sampler.update(out['sampler_idx'], out['sampler_loss'])
             assert not np.isnan(loss_value), 'Model diverged with loss = NaN'
+            input_waits.append(wait_value)
+            step_durations.append(duration)
+            if autotuner is not None:
+                threads += autotuner.update(
+                    sess, coord, wait_value, duration, step)
+            if step % config.input_summary_steps == 0:
+                input_summary = [
+                    tf.Summary.Value(
+                        tag='input/wait seconds',
+                        simple_value=np.mean(input_waits)),
+                    tf.Summary.Value(
+                        tag='input/wait fraction',
+                        simple_value=np.sum(input_waits) / np.sum(
+                            step_durations))]
+                input_summary += [
+                    tf.Summary.Value(
+                        tag='input/fill %s' % name, simple_value=fill)
+                    for name, fill in sess.run(queue_fills).items()]
+                input_summary += profiler.get_summary_values()
+                summary_writer.add_summary(
+                    tf.Summary(value=input_summary), step)
+                input_waits, step_durations = [], []
 
-            if step % config.steps_before_validation == 0:
-                if validation_data is not False:
+            if validation_step:
+                if validation_data is not False and config.full_validation:
+                    val_metrics = evaluate_validation_set(
+                        sess=sess,
+                        val_set=val_set,
+                        images=val_images,
+                        predictions=val_model.fc8,
+                        occlusion_predictions=getattr(
+                            val_model, 'fc8_occlusion', None),
+                        label_scale=label_scale)
+                    val_acc = val_metrics['mean_joint_error']
+                    val_summary = [
+                        tf.Summary.Value(
+                            tag='validation loss',
+                            simple_value=val_metrics['loss']),
+                        tf.Summary.Value(
+                            tag='validation joint error',
+                            simple_value=val_acc)]
+                    val_summary += [
+                        tf.Summary.Value(
+                            tag='validation joint error/%s' % joint,
+                            simple_value=err)
+                        for joint, err in zip(
+                            config.joint_order, val_metrics['joint_error'])]
+                    if 'occlusion_accuracy' in val_metrics:
+                        val_summary += [tf.Summary.Value(
+                            tag='validation occlusion accuracy',
+                            simple_value=val_metrics['occlusion_accuracy'])]
+                    summary_writer.add_summary(
+                        tf.Summary(value=val_summary), step)
+                    write(
+                        np.savez,
+                        os.path.join(
+                            config.model_output, '%s_val_coors' % step),
+                        val_pred=val_metrics['predictions'],
+                        summed_joint_error=val_metrics['summed_joint_error'])
+                    checkpoint_metrics = dict(
+                        (k, val_metrics[k]) for k in [
+                            'loss', 'mean_joint_error', 'joint_error',
+                            'occlusion_accuracy'] if k in val_metrics)
+                    checkpoint_score = val_acc
+                elif validation_data is not False:
                     val_acc, val_pred, val_ims = sess.run(
                         [val_score, val_model.fc8, val_images])
+                    checkpoint_metrics = {'batch_loss': val_acc}
+                    checkpoint_score = val_acc
 
-                    np.savez(
+                    write(
+                        np.savez,
                         os.path.join(
                             config.model_output, '%s_val_coors' % step),
                         val_pred=val_pred, val_ims=val_ims)
                 else:
                     val_acc = -1  # Store every checkpoint
+                    checkpoint_metrics = {}
+                    checkpoint_score = None
+                checkpoint_metrics['training_loss'] = loss_value
+
+                # Learning rate schedule and early stopping
+                if config.use_training_loss or checkpoint_score is None:
+                    plateau_score = np.mean(
+                        losses[-config.steps_before_validation:])
+                else:
+                    plateau_score = checkpoint_score
+                lr_value, stop_training, decision = plateau_monitor.update(
+                    plateau_score, lr_value)
+                sess.run(
+                    update_schedule,
+                    feed_dict={
+                        schedule_values[learning_rate]: lr_value,
+                        schedule_values[plateau_best]: plateau_monitor.best,
+                        schedule_values[plateau_rounds]:
+                            plateau_monitor.bad_rounds})
+                print 'Step %d schedule: %s' % (step, decision)
+                summary_writer.add_summary(
+                    tf.Summary(value=[
+                        tf.Summary.Value(
+                            tag='learning rate', simple_value=lr_value),
+                        tf.Summary.Value(
+                            tag='plateau rounds',
+                            simple_value=plateau_monitor.bad_rounds)]),
+                    step)
+                checkpoint_metrics['learning_rate'] = lr_value
 
                 # Summaries
                 summary_str = sess.run(summary_op)
@@ -273,34 +700,66 @@ def train_and_eval(config):
                     datetime.now(), step, loss_value,
                     config.train_batch / duration, float(duration),
                     train_acc, val_acc, config.summary_dir))
+                breakdown = profiler.get_breakdown()
+                print 'Step time: %.0f%% input wait, %.0f%% compute, ' \
+                    '%.0f%% transfer' % (
+                        100 * breakdown['input wait'],
+                        100 * breakdown['compute'],
+                        100 * breakdown['transfer'])
+                if sampler is not None:
+                    sampler_stats = sampler.get_stats()
+                    print 'Hard examples: %.1f%% of frames scored, max ' \
+                        'weight %.2f' % (
+                            100 * sampler_stats['seen'],
+                            sampler_stats['max_weight'])
 
-                # Save the model checkpoint if it's the best yet
+                # Save the diagnostics and the checkpoint (kept if it's
+                # among the best yet)
+                im, yhat, ytrue = out['im'], out['yhat'], out['ytrue']
+                occhat, occtrue = out['occhat'], out['occtrue']
                 if config.normalize_labels:
                     normalize_vec = np.asarray(
                         config.image_target_size[:2] + [config.max_depth]).reshape(
                         1, -1).repeat(23, axis=0).reshape(1, -1)
                     yhat *= normalize_vec
                     ytrue *= normalize_vec
-                np.save(
+                write(
+                    np.save,
                     os.path.join(results_dir, 'im_%s' % step), im)
-                np.save(
+                write(
+                    np.save,
                     os.path.join(results_dir, 'yhat_%s' % step), yhat)
-                np.save(
+                write(
+                    np.save,
                     os.path.join(results_dir, 'yhrhat_%s' % step), yhat)
-                np.save(
+                write(
+                    np.save,
                     os.path.join(results_dir, 'ylrhat_%s' % step), yhat)
-                np.save(
+                write(
+                    np.save,
                     os.path.join(results_dir, 'ytrue_%s' % step), ytrue)
-                np.save(
+                write(
+                    np.save,
                     os.path.join(results_dir, 'occhat_%s' % step), occhat)
-                np.save(
+                write(
+                    np.save,
                     os.path.join(results_dir, 'occtrue_%s' % step), occtrue)
-                saver.save(
-                    sess, os.path.join(
-                        config.train_checkpoint,
-                        'model_' + str(step) + '.ckpt'), global_step=step)
+                if writer is not None:
+                    if checkpoint_written is not None:
+                        # The shadow variables hold the last snapshot until
+                        # it is on disk
+                        checkpoint_written.wait()
+                    sess.run(snapshot_op)
+                checkpoint_written = write(
+                    save_checkpoint,
+                    step,
+                    checkpoint_score,
+                    checkpoint_metrics)
+                if stop_training:
+                    print 'Stopped early at step %d.' % step
+                    break
 
-            else:
+            elif log_step:
                 # Training status
                 format_str = ('%s: step %d, loss = %.2f (%.1f examples/sec; '
                               '%.3f sec/batch) | Training F = %s')
@@ -314,6 +773,11 @@ def train_and_eval(config):
         print('Done training for %d epochs, %d steps.' % (config.epochs, step))
     finally:
         coord.request_stop()
+        if writer is not None:
+            # Flush the queued diagnostics and checkpoints
+            writer.close()
+        if checkpoint_manager.best() is not None:
+            print 'Best checkpoint: %s' % checkpoint_manager.best()
 
         dt_stamp = get_dt()  # date-time stamp
         np.save(
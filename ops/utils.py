@@ -1,6 +1,13 @@
 import os
 import re
+import sys
+import json
+import Queue
+import threading
 import numpy as np
+import tensorflow as tf
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from glob import glob
 from datetime import datetime
 
@@ -13,3 +20,106 @@ def get_dt():
     return re.split(
         '\.', str(datetime.now()))[0].\
         replace(' ', '_').replace(':', '_').replace('-', '_')
+
+
+def get_shard_name(tf_name, shard, num_shards):
+    """Turns train.tfrecords into train-00003-of-00032.tfrecords."""
+    prefix, ext = os.path.splitext(tf_name)
+    return '%s-%05d-of-%05d%s' % (prefix, shard, num_shards, ext)
+
+
+def read_dataset_header(tfrecord_dir, header_name):
+    """Reads the header describing how a tfrecord dataset was encoded.
+    Datasets written before headers existed are format version 1: three
+    float32 depth channels."""
+    header_path = os.path.join(tfrecord_dir, header_name)
+    if not os.path.exists(header_path):
+        return {'format_version': 1, 'depth_encoding': 'float32'}
+    with open(header_path) as f:
+        return json.load(f)
+
+
+def write_dataset_header(tfrecord_dir, header_name, header):
+    with open(os.path.join(tfrecord_dir, header_name), 'w') as f:
+        json.dump(header, f, indent=4)
+
+
+def get_tfrecord_options(compression):
+    """TFRecordOptions for compression (None, 'ZLIB' or 'GZIP'). Readers
+    and writers of a dataset must use the same options."""
+    if compression is None:
+        return None
+    return tf.python_io.TFRecordOptions(
+        getattr(tf.python_io.TFRecordCompressionType, compression))
+
+
+def prefetch_map(fn, items, num_threads=4, read_ahead=16):
+    """Maps fn over items with a thread pool and yields the results in
+    order. At most read_ahead calls are in flight, which bounds memory while
+    I/O-bound calls overlap with whatever consumes the results."""
+    pool = ThreadPool(num_threads)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(fn, (item,)))
+            if len(pending) >= read_ahead:
+                yield pending.popleft().get()
+        while len(pending):
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+
+class AsyncWriter(object):
+    """Runs file writes (np.save, np.savez, Saver.save, ...) in order on a
+    background thread so the caller keeps going while they run. At most
+    max_pending writes are queued: put blocks beyond that, so a writer that
+    falls behind slows the caller down instead of holding every array in
+    memory. A failed write is re-raised by the next put, flush or close.
+    close (or flush) waits until everything queued is on disk."""
+
+    def __init__(self, max_pending=32):
+        self.queue = Queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            fn, args, kwargs, done = item
+            try:
+                if self.error is None:
+                    fn(*args, **kwargs)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                done.set()
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def put(self, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs). Returns an Event set once it ran."""
+        self.check()
+        done = threading.Event()
+        self.queue.put((fn, args, kwargs, done))
+        return done
+
+    def flush(self):
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
@@ -0,0 +1,75 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+from timeit import default_timer as timer
+from ops.data_processing_joints import encode_depth, encode_example
+from ops.utils import get_tfrecord_options
+from config import monkeyConfig
+
+
+def synthetic_frames(config, num_frames, image_size=None):
+    """Depth renders that look like ours: zero background with one blob of
+    smoothly varying depth where the monkey would be. image_size ([h, w,
+    channels]) defaults to config.image_target_size."""
+    if image_size is None:
+        image_size = config.image_target_size
+    h, w = image_size[:2]
+    yy, xx = np.mgrid[:h, :w]
+    for _ in range(num_frames):
+        cy, cx = np.random.randint(h // 4, 3 * h // 4), np.random.randint(
+            w // 4, 3 * w // 4)
+        radius = np.random.randint(h // 8, h // 4)
+        blob = ((yy - cy) ** 2 + (xx - cx) ** 2) < radius ** 2
+        depth = np.zeros((h, w, image_size[2]), np.float32)
+        depth[blob] = (
+            config.max_depth / 2 + np.random.randn(blob.sum()) * 20)[:, None]
+        label = np.random.rand(config.num_classes).astype(np.float32)
+        yield depth, label
+
+
+def run_benchmark(config, num_frames=512, out_dir=None):
+    """Writes the same frames uncompressed, with ZLIB and with GZIP and
+    times a full read + decode pass over each file. Point out_dir at the
+    share to include its bandwidth; by default a local temp dir is used,
+    which measures the reader CPU cost only."""
+    tmp_dir = tempfile.mkdtemp(dir=out_dir)
+    try:
+        frames = list(synthetic_frames(config, num_frames))
+        sizes, read_times = {}, {}
+        for compression in [None, 'ZLIB', 'GZIP']:
+            options = get_tfrecord_options(compression)
+            tf_file = os.path.join(tmp_dir, '%s.tfrecords' % compression)
+            with tf.python_io.TFRecordWriter(
+                    tf_file, options=options) as tfrecord_writer:
+                for depth, label in frames:
+                    tfrecord_writer.write(encode_example(
+                        im=encode_depth(
+                            depth, config.depth_encoding, config.max_depth),
+                        label=label))
+            sizes[compression] = os.path.getsize(tf_file)
+
+            start = timer()
+            for record in tf.python_io.tf_record_iterator(
+                    tf_file, options=options):
+                example = tf.train.Example.FromString(record)
+                example.features.feature['image'].bytes_list.value[0]
+            read_times[compression] = timer() - start
+
+        for compression in [None, 'ZLIB', 'GZIP']:
+            sys.stdout.write(
+                '%s: %.1f MB (%.2fx smaller), %.1f frames/sec read\n' % (
+                    compression,
+                    sizes[compression] / 1e6,
+                    float(sizes[None]) / sizes[compression],
+                    num_frames / read_times[compression]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    config = monkeyConfig()
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else None
+    run_benchmark(config, out_dir=out_dir)
@@ -0,0 +1,108 @@
+import sys
+import argparse
+import tensorflow as tf
+from timeit import default_timer as timer
+from config import monkeyConfig
+
+
+def get_model_struct(model_type):
+    if model_type == 'cnn_multiscale_low_high_res_mid_loss':
+        from models.cnn_multiscale_low_high_res_mid_loss import model_struct
+    elif model_type == 'cnn_multiscale_low_high_res':
+        from models.cnn_multiscale_low_high_res import model_struct
+    else:
+        raise RuntimeError(
+            'Benchmark the fetches with a multiscale model, not %s.' %
+            model_type)
+    return model_struct
+
+
+def time_fetches(config, lean, num_steps=200, warmup=20):
+    """Trains the configured model on a fixed random batch held on the GPU
+    (so the input pipeline is out of the picture) and returns the
+    examples/sec with the lean (train_op and loss) or the full per-step
+    fetches of train_and_eval."""
+    model_struct = get_model_struct(config.model_type)
+    batch_shape = [config.train_batch] + config.image_target_size[:2] + [1]
+    with tf.Graph().as_default():
+        with tf.device('/gpu:0'):
+            images = tf.Variable(
+                tf.random_uniform(batch_shape), trainable=False)
+            labels = tf.Variable(
+                tf.random_uniform([config.train_batch, config.num_classes]),
+                trainable=False)
+            occlusions = tf.Variable(
+                tf.cast(tf.random_uniform(
+                    [config.train_batch, config.num_classes // 3]) > 0.2,
+                    tf.float32),
+                trainable=False)
+            with tf.variable_scope('cnn'):
+                model = model_struct()
+                train_mode = tf.get_variable(
+                    name='training', initializer=True)
+                model.build(
+                    rgb=images,
+                    output_shape=config.num_classes,
+                    train_mode=train_mode,
+                    batchnorm=config.batch_norm)
+                loss = tf.nn.l2_loss(model.fc8 - labels) + \
+                    tf.nn.l2_loss(
+                        model.high_feature_encoder_joints - labels) + \
+                    tf.nn.l2_loss(
+                        model.low_feature_encoder_joints - labels)
+                train_op = tf.train.AdamOptimizer(config.lr).minimize(loss)
+        fetches = {'train_op': train_op, 'loss': loss}
+        if not lean:
+            fetches.update({
+                'im': images,
+                'yhat': model.fc8,
+                'yhrhat': model.high_feature_encoder_joints,
+                'ylrhat': model.low_feature_encoder_joints,
+                'ytrue': labels,
+                'occhat': model.fc8_occlusion,
+                'occtrue': occlusions
+            })
+        with tf.Session(config=tf.ConfigProto(
+                allow_soft_placement=True)) as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(warmup):
+                sess.run(fetches)
+            start = timer()
+            for _ in range(num_steps):
+                sess.run(fetches)
+            duration = timer() - start
+    return num_steps * config.train_batch / duration
+
+
+def run_benchmark(num_steps=200, warmup=20):
+    """Measured so far, CPU only (TF 1.15.0, 1 core, no GPU), --steps 12
+    --warmup 2: full 0.9, lean 0.8 examples/sec (0.92x, within noise at
+    ~19 s per step). Transfer is a host memcpy there, so this shows no
+    gain; the GPU comparison has not been measured."""
+    config = monkeyConfig()
+    full_rate = time_fetches(
+        config, lean=False, num_steps=num_steps, warmup=warmup)
+    lean_rate = time_fetches(
+        config, lean=True, num_steps=num_steps, warmup=warmup)
+    sys.stdout.write(
+        'full fetches: %.1f examples/sec\n'
+        'lean fetches: %.1f examples/sec (%.2fx)\n' % (
+            full_rate, lean_rate, lean_rate / full_rate))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--steps",
+        dest="num_steps",
+        type=int,
+        default=200,
+        help='Timed training steps per fetch policy.')
+    parser.add_argument(
+        "--warmup",
+        dest="warmup",
+        type=int,
+        default=20,
+        help='Untimed steps before timing.')
+    args = parser.parse_args()
+    run_benchmark(**vars(args))
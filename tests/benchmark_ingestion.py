@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import tensorflow as tf
+from timeit import default_timer as timer
+from ops.data_processing_joints import process_data, get_frame_index, \
+    read_frame, prepare_frames, crop_frame, encode_depth, encode_example
+from ops.utils import get_tfrecord_options
+from config import monkeyConfig
+from benchmark_compression import synthetic_frames
+
+
+def make_synthetic_tree(config, num_frames):
+    """Writes num_frames fake renders in the layout monkeyConfig expects:
+    depth/true_depth, labels/joint_coords, labels/pixel_joint_coords and
+    labels/occlusions, one .npy per frame. Depth frames are zero background
+    with a blob of foreground depth, like the Maya renders."""
+    for d in [
+            config.depth_dir, config.label_dir, config.pixel_label_dir,
+            config.occlusion_dir]:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    h, w = config.image_input_size[:2]
+    num_joints = config.num_classes // 3
+    frames = synthetic_frames(
+        config, num_frames, image_size=config.image_input_size[:2] + [3])
+    for i, (depth, _) in enumerate(frames):
+        name = 'frame_%07d' % i
+        joints = np.random.rand(num_joints, 3).astype(np.float32)
+        np.save(os.path.join(
+            config.depth_dir, name + config.image_extension), depth)
+        np.save(os.path.join(
+            config.label_dir, name + config.label_extension), joints)
+        np.save(os.path.join(
+            config.pixel_label_dir, name + config.label_extension),
+            joints * [w, h, 1])
+        np.save(os.path.join(
+            config.occlusion_dir, name + config.occlusion_extension),
+            np.random.rand(num_joints) > 0.2)
+
+
+def point_config_at(config, root):
+    config.image_dir = root
+    config.depth_dir = os.path.join(root, 'depth', 'true_depth')
+    config.label_dir = os.path.join(root, 'labels', 'joint_coords')
+    config.pixel_label_dir = os.path.join(
+        root, 'labels', 'pixel_joint_coords')
+    config.occlusion_dir = os.path.join(root, 'labels', 'occlusions')
+    config.tfrecord_dir = os.path.join(root, 'tfrecords')
+    config.memmap_dir = os.path.join(root, 'memmaps')
+    config.use_image_labels = False
+    return config
+
+
+def time_stages(config, num_frames):
+    """Runs the ingestion stages back to back in this process and returns
+    the seconds spent in each. Like create_joint_tf_records, frames are
+    loaded and resized config.ingestion_read_ahead at a time (one
+    prepare_frames call per chunk) and then encoded and written one by
+    one."""
+    depth_files, label_files, pixel_label_files, occlusion_files = \
+        get_frame_index(config)
+    num_files = len(depth_files)
+    if pixel_label_files is None:
+        pixel_label_files = [None] * num_files
+    if occlusion_files is None:
+        occlusion_files = [None] * num_files
+    timings = dict((k, 0.) for k in ['load', 'resize', 'encode', 'write'])
+    tf_file = os.path.join(config.tfrecord_dir, 'stage_timing.tfrecords')
+    with tf.python_io.TFRecordWriter(
+            tf_file,
+            options=get_tfrecord_options(
+                config.tfrecord_compression)) as tfrecord_writer:
+        num_frames = min(num_frames, num_files)
+        for chunk_start in range(0, num_frames, config.ingestion_read_ahead):
+            chunk = range(
+                chunk_start,
+                min(chunk_start + config.ingestion_read_ahead, num_frames))
+            start = timer()
+            frames = [
+                read_frame(
+                    (depth_files[i], label_files[i], pixel_label_files[i],
+                        occlusion_files[i]),
+                    config)
+                for i in chunk]
+            timings['load'] += timer() - start
+
+            start = timer()
+            frames = prepare_frames(frames, config)
+            timings['resize'] += timer() - start
+
+            for frame in frames:
+                if frame is None:
+                    continue
+                start = timer()
+                depth_image, label_vector, occlusion, im_label = frame
+                crop, label_offset = None, None
+                if config.crop_to_monkey:
+                    depth_image, label_vector, crop, label_offset = \
+                        crop_frame(depth_image, label_vector, config)
+                example = encode_example(
+                    im=encode_depth(
+                        depth_image, config.depth_encoding,
+                        config.max_depth),
+                    label=label_vector,
+                    occlusion=occlusion,
+                    crop=crop,
+                    label_offset=label_offset)
+                timings['encode'] += timer() - start
+
+                start = timer()
+                tfrecord_writer.write(example)
+                timings['write'] += timer() - start
+    os.remove(tf_file)
+    return timings
+
+
+def get_dir_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(d, f))
+        for d, _, files in os.walk(directory) for f in files)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(num_frames, output, root=None, stage_frames=256):
+    """Generates a synthetic render tree, ingests it with process_data and
+    writes frames/sec, bytes written, peak RSS and per-stage timings to the
+    JSON file output."""
+    config = monkeyConfig()
+    keep_root = root is not None
+    if root is None:
+        root = tempfile.mkdtemp()
+    config = point_config_at(config, root)
+    try:
+        print 'Writing %s synthetic frames to %s' % (num_frames, root)
+        make_synthetic_tree(config, num_frames)
+
+        start = time.time()
+        process_data(config)
+        duration = time.time() - start
+        if config.dataset_backend == 'memmap':
+            bytes_written = get_dir_size(config.memmap_dir)
+        else:
+            bytes_written = get_dir_size(config.tfrecord_dir)
+        # ru_maxrss is in KB on linux
+        peak_rss = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+        stage_times = time_stages(config, stage_frames)
+        results = {
+            'commit': get_commit(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'num_frames': num_frames,
+            'seconds': duration,
+            'frames_per_sec': num_frames / duration,
+            'bytes_written': bytes_written,
+            'peak_rss_bytes': peak_rss,
+            'stage_frames': min(stage_frames, num_frames),
+            'stage_seconds': stage_times,
+            'config': {
+                'dataset_backend': config.dataset_backend,
+                'depth_encoding': config.depth_encoding,
+                'tfrecord_compression': config.tfrecord_compression,
+                'crop_to_monkey': config.crop_to_monkey,
+                'tfrecord_shards': config.tfrecord_shards,
+                'ingestion_workers': config.ingestion_workers,
+                'ingestion_io_threads': config.ingestion_io_threads,
+                'image_input_size': config.image_input_size,
+                'image_target_size': config.image_target_size,
+            }
+        }
+    finally:
+        if not keep_root:
+            shutil.rmtree(root)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    sys.stdout.write(json.dumps(results, indent=4) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--frames",
+        dest="num_frames",
+        type=int,
+        default=2000,
+        help='Number of synthetic frames to ingest.')
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=str,
+        default='ingestion_benchmark.json',
+        help='JSON file for the results.')
+    parser.add_argument(
+        "--root",
+        dest="root",
+        type=str,
+        default=None,
+        help='Directory for the synthetic tree (kept). Defaults to a '
+        'temporary directory that is removed afterwards.')
+    args = parser.parse_args()
+    run_benchmark(**vars(args))
@@ -0,0 +1,76 @@
+import os
+import sys
+import tensorflow as tf
+from timeit import default_timer as timer
+from ops.data_loader_joints import inputs, dataset_inputs
+from ops.utils import read_dataset_header
+from config import monkeyConfig
+
+
+def time_pipeline(input_fn, config, num_batches=200, warmup=20, **kwargs):
+    """Builds one training input pipeline with input_fn and returns the
+    examples/sec it delivers with no model attached."""
+    dataset_header = read_dataset_header(
+        config.tfrecord_dir, config.dataset_header)
+    with tf.Graph().as_default():
+        images, labels, occlusions = input_fn(
+            tfrecord_file=os.path.join(
+                config.tfrecord_dir, config.train_tfrecords),
+            batch_size=config.train_batch,
+            im_size=config.resize,
+            target_size=config.image_target_size,
+            model_input_shape=config.resize,
+            train=config.data_augmentations,
+            label_shape=config.num_classes,
+            image_target_size=config.image_target_size,
+            image_input_size=config.image_input_size,
+            maya_conversion=config.maya_conversion,
+            max_value=config.max_depth,
+            return_occlusions=config.occlusion_dir,
+            normalize_labels=config.normalize_labels,
+            num_readers=config.num_readers,
+            depth_encoding=dataset_header['depth_encoding'],
+            cropped=dataset_header.get('crop_to_monkey', False),
+            compression=dataset_header.get('compression'),
+            **kwargs)
+        fetches = [images, labels]
+        if occlusions is not None:
+            fetches += [occlusions]
+        with tf.Session() as sess:
+            sess.run(tf.group(
+                tf.global_variables_initializer(),
+                tf.local_variables_initializer()))
+            coord = tf.train.Coordinator()
+            threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+            for _ in range(warmup):
+                sess.run(fetches)
+            start = timer()
+            for _ in range(num_batches):
+                sess.run(fetches)
+            duration = timer() - start
+            coord.request_stop()
+            coord.join(threads)
+    return num_batches * config.train_batch / duration
+
+
+def run_benchmark(config):
+    for batch_decode in [False, True]:
+        queue_rate = time_pipeline(
+            inputs, config, batch_decode=batch_decode)
+        dataset_rate = time_pipeline(
+            dataset_inputs,
+            config,
+            num_parallel_calls=config.num_parallel_calls,
+            prefetch_batches=config.prefetch_batches,
+            batch_decode=batch_decode)
+        sys.stdout.write(
+            'batch_decode=%s\n'
+            'queue runners: %.1f examples/sec\n'
+            'tf.data: %.1f examples/sec (%.2fx)\n' % (
+                batch_decode, queue_rate, dataset_rate,
+                dataset_rate / queue_rate))
+
+
+if __name__ == '__main__':
+    config = monkeyConfig()
+    run_benchmark(config)
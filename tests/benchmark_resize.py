@@ -0,0 +1,43 @@
+import sys
+import numpy as np
+from timeit import default_timer as timer
+from skimage.transform import resize
+from ops.data_processing_joints import resize_depth_frames
+from config import monkeyConfig
+
+
+def run_benchmark(config, num_frames=256, repeats=3):
+    """Compares per-frame skimage resizing with resize_depth_frames on a
+    batch of random renders and checks that both give the same pixels."""
+    frames = np.random.rand(
+        *([num_frames] + config.image_input_size + [3])).astype(np.float32)
+    frames[frames < 0.5] = 0  # background
+
+    skimage_times, strided_times = [], []
+    for _ in range(repeats):
+        start = timer()
+        reference = np.stack([
+            resize(
+                frame,
+                config.image_target_size[:2],
+                preserve_range=True,
+                order=0) for frame in frames])
+        skimage_times.append(timer() - start)
+
+        start = timer()
+        strided = resize_depth_frames(frames, config.image_target_size)
+        strided_times.append(timer() - start)
+
+    skimage_fps = num_frames / min(skimage_times)
+    strided_fps = num_frames / min(strided_times)
+    sys.stdout.write(
+        'skimage resize: %.1f frames/sec\n'
+        'strided resize: %.1f frames/sec (%.1fx)\n'
+        'identical output: %s\n' % (
+            skimage_fps, strided_fps, strided_fps / skimage_fps,
+            np.array_equal(reference, strided)))
+
+
+if __name__ == '__main__':
+    config = monkeyConfig()
+    run_benchmark(config)
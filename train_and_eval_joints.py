@@ -1,10 +1,11 @@
 import argparse
 from ops.tf_model_cnn_joints import train_and_eval
-from ops.data_processing_joints import process_data
+from ops.data_processing_joints import process_data, \
+    export_normalized_tfrecords
 from config import monkeyConfig
 
 
-def main(extract_features=False):
+def main(extract_features=False, export_normalized=False):
     config = monkeyConfig()
 
     # Encodes files into tfrecords
@@ -14,6 +15,13 @@ def main(extract_features=False):
         print '-'*60
         process_data(config)
 
+    # Writes model-ready copies of the tfrecords
+    if export_normalized:
+        print '-'*60
+        print 'Exporting normalized tfrecords'
+        print '-'*60
+        export_normalized_tfrecords(config)
+
     # Trains a random forest model
     train_and_eval(config)
 
@@ -25,5 +33,10 @@ if __name__ == '__main__':
         dest="extract_features",
         action='store_true',
         help='Extract features -> tfrecords or reuse existing.')
+    parser.add_argument(
+        "--export_normalized",
+        dest="export_normalized",
+        action='store_true',
+        help='Export normalized tfrecords to config.normalized_tfrecord_dir.')
     args = parser.parse_args()
     main(**vars(args))